@@ -1,11 +1,11 @@
 # -*- mode: python ; coding: utf-8 -*-
-from PyInstaller.utils.hooks import collect_all
+from PyInstaller.utils.hooks import collect_all, collect_submodules
 
 datas = [('requirements.txt', '.'), ('app.py', '.')]
 binaries = []
 hiddenimports = ['PIL._tkinter_finder', 'tkinter', 'tkinter.filedialog']
-tmp_ret = collect_all('markdownify')
-datas += tmp_ret[0]; binaries += tmp_ret[1]; hiddenimports += tmp_ret[2]
+# Markdown扩展按名称动态导入，需要显式收集
+hiddenimports += collect_submodules('markdown')
 tmp_ret = collect_all('ebooklib')
 datas += tmp_ret[0]; binaries += tmp_ret[1]; hiddenimports += tmp_ret[2]
 tmp_ret = collect_all('PIL')
@@ -1,9 +1,15 @@
+import os
 import tkinter as tk
 from gui import MarkdownToEpubApp
 
 def main():
     root = tk.Tk()
     app = MarkdownToEpubApp(root)
+    if os.environ.get('MD2EPUB_STARTUP_PROBE'):
+        # 启动测试（bench_startup.py）：窗口显示并可以交互后立即退出
+        root.update()
+        root.destroy()
+        return
     root.mainloop()
 
 if __name__ == "__main__":
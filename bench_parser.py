@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+对比每个章节新建Markdown解析器与复用解析器的开销
+
+用法: python bench_parser.py [章节数] [重复次数]
+"""
+import sys
+import time
+import markdown
+
+from converter import EpubConverter, MARKDOWN_EXTENSIONS
+
+
+def make_corpus(count):
+    """生成大量短小的Markdown笔记"""
+    corpus = []
+    for i in range(count):
+        corpus.append(
+            f"# 笔记 {i}\n\n"
+            f"这是第{i}条笔记，包含**粗体**、*斜体*和`代码`。\n\n"
+            f"## 小节\n\n- 条目一\n- 条目二\n\n"
+            f"| 列1 | 列2 |\n|-----|-----|\n| {i} | {i * 2} |\n"
+        )
+    return corpus
+
+
+def bench(name, render, corpus, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for md_content in corpus:
+            render(md_content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    per_chapter = best / len(corpus) * 1e6
+    print(f"{name:<20} 总耗时 {best * 1000:8.1f} ms  每章节 {per_chapter:8.1f} µs")
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    corpus = make_corpus(count)
+    converter = EpubConverter()
+
+    print(f"章节数: {count}，重复次数: {repeat}，扩展: {', '.join(MARKDOWN_EXTENSIONS)}")
+    before = bench(
+        "markdown.markdown",
+        lambda md_content: markdown.markdown(md_content, extensions=MARKDOWN_EXTENSIONS),
+        corpus,
+        repeat
+    )
+    after = bench(
+        "复用解析器",
+        lambda md_content: converter.get_markdown_parser().convert(md_content),
+        corpus,
+        repeat
+    )
+    print(f"加速比: {before / after:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+启动耗时测试
+
+用python -X importtime统计图形界面和命令行入口的导入耗时，检查启动时没有导入
+markdown、ebooklib、Pillow等重型依赖，并可以测量窗口（或打包后的程序）显示到
+可以交互所需的时间。超过预算时以退出码1结束。
+
+用法:
+    python bench_startup.py
+    python bench_startup.py --window
+    python bench_startup.py --frozen dist/Markdown2EPUB/Markdown2EPUB --frozen-budget-ms 2000
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# 启动路径上的模块：(名称, 导入的模块)
+TARGETS = (
+    ('gui', 'app'),
+    ('cli', 'md2epub'),
+)
+
+# 启动时不应导入的重型依赖，它们只在转换对应阶段运行时才需要
+HEAVY_MODULES = ('markdown', 'ebooklib', 'lxml', 'PIL', 'multiprocessing', 'concurrent.futures.process')
+
+
+def import_times(module):
+    """在新的解释器中导入模块，返回该模块导入树中的[(模块名, 自身耗时, 累计耗时, 层级)]
+
+    耗时单位为微秒，解释器启动时自身导入的模块（site等）不包括在内。
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入{module}失败:\n{result.stderr}")
+
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), depth))
+
+    # importtime按后序输出，目标模块的导入树是它之前、上一个顶层模块之后的连续条目
+    end = max(i for i, entry in enumerate(entries) if entry[0] == module and entry[3] == 0)
+    start = end
+    while start > 0 and entries[start - 1][3] > 0:
+        start -= 1
+    return entries[start:end + 1]
+
+
+def check_imports(label, module, budget_ms, top):
+    """统计一个启动入口的导入耗时，返回是否满足预算且没有导入重型依赖"""
+    entries = import_times(module)
+    total_ms = entries[-1][2] / 1000
+    heavy = sorted({
+        name for name, _, _, _ in entries
+        if any(name == heavy or name.startswith(heavy + '.') for heavy in HEAVY_MODULES)
+    })
+
+    print(f"{label}: import {module} 共 {total_ms:.1f} ms（预算 {budget_ms:.0f} ms）")
+    # 列出目标模块直接导入的模块中累计耗时最长的几个
+    children = sorted((entry for entry in entries if entry[3] == 1), key=lambda entry: entry[2], reverse=True)
+    for name, _, cumulative_us, _ in children[:top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    ok = total_ms <= budget_ms
+    if not ok:
+        print(f"  超出预算 {total_ms - budget_ms:.1f} ms")
+    if heavy:
+        print(f"  启动时导入了重型依赖: {', '.join(heavy)}")
+        ok = False
+    return ok
+
+
+def time_launch(command, repeat):
+    """启动程序并等待它在窗口可以交互后退出，返回最短耗时（毫秒），失败时返回None"""
+    env = dict(os.environ, MD2EPUB_STARTUP_PROBE='1')
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        if result.returncode != 0:
+            print(f"  启动失败: {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else result.returncode}")
+            return None
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def check_launch(label, command, budget_ms, repeat):
+    elapsed = time_launch(command, repeat)
+    if elapsed is None:
+        return False
+    print(f"{label}: 窗口可以交互用时 {elapsed:.0f} ms（预算 {budget_ms:.0f} ms，{repeat} 次取最短）")
+    return elapsed <= budget_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动耗时测试")
+    parser.add_argument('--budget-ms', type=float, default=100, help="每个入口的导入耗时预算（毫秒）")
+    parser.add_argument('--top', type=int, default=5, help="列出最慢的几个顶层导入")
+    parser.add_argument('--window', action='store_true', help="同时测量源码运行时窗口显示到可以交互的时间（需要图形环境）")
+    parser.add_argument('--window-budget-ms', type=float, default=1000, help="源码运行时的窗口预算（毫秒）")
+    parser.add_argument('--frozen', help="打包后的可执行文件，测量其窗口显示到可以交互的时间")
+    parser.add_argument('--frozen-budget-ms', type=float, default=3000, help="打包程序的窗口预算（毫秒）")
+    parser.add_argument('--repeat', type=int, default=5, help="测量窗口时的重复次数")
+    args = parser.parse_args()
+
+    ok = True
+    for label, module in TARGETS:
+        ok &= check_imports(label, module, args.budget_ms, args.top)
+
+    if args.window:
+        ok &= check_launch('gui', [sys.executable, 'app.py'], args.window_budget_ms, args.repeat)
+    if args.frozen:
+        ok &= check_launch('frozen', [os.path.abspath(args.frozen)], args.frozen_budget_ms, args.repeat)
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+目录生成基准测试
+
+合成一本标题数量很多的书（例如10万个标题的API参考），分别计时目录树的生成和
+ebooklib写出nav.xhtml、toc.ncx，输出目录项数和文件大小，并对比设置目录项上限时的结果。
+标题直接合成，不经过Markdown渲染，只测量目录相关的开销。
+
+用法:
+    python bench_toc.py
+    python bench_toc.py --headings 100000 --chapters 200 --depth 6 --max-entries 5000
+"""
+import time
+import random
+import argparse
+
+from ebooklib import epub
+
+from converter import EpubConverter
+
+# 各级标题的相对数量：API参考中深层标题（方法、参数）远多于浅层标题
+LEVEL_WEIGHTS = (1, 4, 12, 30, 40, 13)
+
+
+def make_chapters(converter, chapter_count, heading_count, duplicates, seed=0):
+    """生成chapter_count个章节，共heading_count个标题，duplicates比例的标题文本和ID重复"""
+    rng = random.Random(seed)
+    per_chapter = heading_count // chapter_count
+    chapters = []
+    for index in range(chapter_count):
+        headings = [(1, f"模块 {index}", f"module-{index}")]
+        level = 1
+        for i in range(per_chapter - 1):
+            # 下一个标题最多比上一个深一级，可以回到任意较浅的级别
+            level = rng.choices(range(1, min(level + 1, 6) + 1),
+                                weights=LEVEL_WEIGHTS[:min(level + 1, 6)])[0]
+            level = max(level, 2)
+            if rng.random() < duplicates:
+                # 同一章节中重复的标题，例如每个类都有的__init__
+                headings.append((level, "__init__", "__init__"))
+            else:
+                headings.append((level, f"api_{index}_{i}", f"api-{index}-{i}"))
+        chapter = epub.EpubHtml(title=f"模块 {index}", file_name=f"chapter_{index}.xhtml", lang='zh-CN')
+        chapter.content = f"<h1>模块 {index}</h1>"
+        chapter.headings = headings
+        converter.book.add_item(chapter)
+        chapters.append(chapter)
+    return chapters
+
+
+def count_entries(toc):
+    total = 0
+    for entry in toc:
+        if isinstance(entry, tuple):
+            total += 1 + count_entries(entry[1])
+        else:
+            total += 1
+    return total
+
+
+def run(chapter_count, heading_count, depth, max_entries, duplicates):
+    converter = EpubConverter(toc_depth=depth, toc_max_entries=max_entries)
+    converter.create_book("目录基准测试", "md2epub")
+    chapters = make_chapters(converter, chapter_count, heading_count, duplicates)
+
+    start = time.perf_counter()
+    converter.generate_toc(chapters)
+    toc_seconds = time.perf_counter() - start
+
+    writer = epub.EpubWriter('unused.epub', converter.book, {})
+    start = time.perf_counter()
+    nav = writer._get_nav(converter.book.get_item_with_id('nav'))
+    nav_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    ncx = writer._get_ncx()
+    ncx_seconds = time.perf_counter() - start
+
+    label = f"上限 {max_entries}" if max_entries else "不限"
+    print(f"{label:<12} 目录项 {count_entries(converter.book.toc):>7}  "
+          f"生成 {toc_seconds * 1000:8.1f} ms  "
+          f"nav {nav_seconds * 1000:8.1f} ms / {len(nav) / 1024:8.0f} KB  "
+          f"ncx {ncx_seconds * 1000:8.1f} ms / {len(ncx) / 1024:8.0f} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="目录生成基准测试")
+    parser.add_argument('--headings', type=int, default=100000, help="标题总数")
+    parser.add_argument('--chapters', type=int, default=200, help="章节数")
+    parser.add_argument('--depth', type=int, choices=range(1, 7), default=6, help="目录深度")
+    parser.add_argument('--max-entries', type=int, default=5000, help="对比的目录项上限")
+    parser.add_argument('--duplicates', type=float, default=0.1, help="重复标题的比例")
+    args = parser.parse_args()
+
+    print(f"章节数: {args.chapters}，标题数: {args.headings}，目录深度: h1-h{args.depth}")
+    run(args.chapters, args.headings, args.depth, None, args.duplicates)
+    run(args.chapters, args.headings, args.depth, args.max_entries, args.duplicates)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+转换器性能基准测试
+
+生成合成的Markdown语料，分阶段计时（读取、Markdown渲染、图片处理、目录生成、保存），
+输出吞吐量和峰值内存，并可以与保存的基准结果比较以发现性能退化。
+
+用法:
+    python benchmark.py --chapters 500 --chapter-size 8 --images 2
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json --threshold 0.15
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from converter import EpubConverter
+
+STAGES = ('read', 'markdown', 'process_images', 'generate_toc', 'save_epub')
+
+WORDS = ("转换 文档 章节 目录 图片 段落 标题 电子书 格式 内容 "
+         "markdown epub chapter heading image table code render").split()
+
+
+def generate_paragraph(rng, words=60):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)) + '\n\n'
+
+
+def generate_chapter(rng, index, size_kb, heading_density, images, image_names, tables, code_blocks):
+    """生成一个约size_kb大小的章节，heading_density为每KB正文的标题数"""
+    parts = [f"# 第{index}章\n\n"]
+    target = size_kb * 1024
+    length = 0
+    heading_count = 0
+    while length < target:
+        paragraph = generate_paragraph(rng)
+        parts.append(paragraph)
+        length += len(paragraph.encode('utf-8'))
+        # 按标题密度插入二级和三级标题
+        while heading_count < length / 1024 * heading_density:
+            heading_count += 1
+            level = '##' if heading_count % 3 else '###'
+            parts.append(f"{level} 小节 {index}.{heading_count}\n\n")
+
+    for i in range(images):
+        parts.append(f"![图{i}](images/{rng.choice(image_names)})\n\n")
+    for i in range(tables):
+        rows = ''.join(f"| {r} | {rng.choice(WORDS)} | {r * i} |\n" for r in range(10))
+        parts.append(f"| 序号 | 名称 | 数值 |\n|---|---|---|\n{rows}\n")
+    for i in range(code_blocks):
+        code = '\n'.join(f"    value_{j} = compute({j}, {i})" for j in range(10))
+        parts.append(f"```python\ndef block_{i}():\n{code}\n```\n\n")
+    return ''.join(parts)
+
+
+def generate_corpus(corpus_dir, chapters, size_kb, heading_density, images, tables, code_blocks,
+                    image_pool=20, seed=0):
+    """在corpus_dir中生成合成语料，返回语料总字节数"""
+    rng = random.Random(seed)
+    images_dir = os.path.join(corpus_dir, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+
+    image_names = []
+    if images:
+        from PIL import Image
+        for i in range(image_pool):
+            name = f'img{i:03d}.png'
+            color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+            Image.new('RGB', (320, 240), color).save(os.path.join(images_dir, name))
+            image_names.append(name)
+
+    total = 0
+    for index in range(1, chapters + 1):
+        content = generate_chapter(rng, index, size_kb, heading_density, images, image_names, tables, code_blocks)
+        path = os.path.join(corpus_dir, f'{index:05d}.md')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        total += len(content.encode('utf-8'))
+    return total
+
+
+def peak_memory_mb():
+    """进程峰值常驻内存（MB），不支持的平台返回None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS以字节为单位，Linux以KB为单位
+    if sys.platform == 'darwin':
+        return peak / 1024 / 1024
+    return peak / 1024
+
+
+def run_benchmark(corpus_dir, output_path, highlight=False):
+    """分阶段执行一次转换，返回每个阶段的耗时（秒），highlight为True时高亮代码块"""
+    timings = dict.fromkeys(STAGES, 0.0)
+    converter = EpubConverter(highlight=highlight)
+    converter.create_book('基准测试', 'benchmark')
+    converter.images_dir = os.path.join(corpus_dir, 'images')
+
+    md_paths = sorted(
+        os.path.join(corpus_dir, name) for name in os.listdir(corpus_dir) if name.endswith('.md')
+    )
+    chapters = []
+    for md_path in md_paths:
+        start = time.perf_counter()
+        with open(md_path, 'r', encoding='utf-8') as f:
+            md_content = f.read()
+        timings['read'] += time.perf_counter() - start
+
+        # 图片在渲染时处理，耗时由转换器的统计单独记录
+        images_time = converter.stats.stages['images']
+        start = time.perf_counter()
+        html_content, headings, refs = converter.render_markdown(md_content, os.path.dirname(md_path))
+        elapsed = time.perf_counter() - start
+        images_elapsed = converter.stats.stages['images'] - images_time
+        timings['markdown'] += elapsed - images_elapsed
+        timings['process_images'] += images_elapsed
+
+        chapters.append(converter._add_chapter(md_path, html_content, headings, refs))
+
+    start = time.perf_counter()
+    converter.generate_toc(chapters)
+    timings['generate_toc'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    converter.save_epub(output_path)
+    timings['save_epub'] = time.perf_counter() - start
+    return timings
+
+
+def compare_baseline(result, baseline, threshold, min_delta=0.005):
+    """与基准结果比较，返回退化的阶段列表
+
+    耗时增长超过threshold比例且绝对值超过min_delta秒才算退化，
+    避免只有几毫秒的阶段因为计时抖动被误报。
+    """
+    regressions = []
+    for stage in STAGES + ('total',):
+        old = baseline['timings'].get(stage)
+        new = result['timings'].get(stage)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        flag = ''
+        if change > threshold and new - old > min_delta:
+            flag = '  <-- 退化'
+            regressions.append(stage)
+        print(f"  {stage:<16} {old * 1000:9.1f} ms -> {new * 1000:9.1f} ms  {change * 100:+6.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="转换器性能基准测试")
+    parser.add_argument('--chapters', type=int, default=200, help="章节数")
+    parser.add_argument('--chapter-size', type=int, default=8, help="每章大小（KB）")
+    parser.add_argument('--heading-density', type=float, default=1.0, help="每KB正文的标题数")
+    parser.add_argument('--images', type=int, default=2, help="每章引用的图片数")
+    parser.add_argument('--tables', type=int, default=1, help="每章的表格数")
+    parser.add_argument('--code-blocks', type=int, default=1, help="每章的代码块数")
+    parser.add_argument('--highlight', action='store_true', help="高亮代码块（需要Pygments）")
+    parser.add_argument('--repeat', type=int, default=3, help="重复次数，取每个阶段的最短耗时")
+    parser.add_argument('--corpus-dir', help="语料目录，默认生成到临时目录并在结束后删除")
+    parser.add_argument('--baseline', help="与该基准结果JSON比较")
+    parser.add_argument('--threshold', type=float, default=0.1, help="判定为退化的耗时增长比例")
+    parser.add_argument('--save-baseline', help="把本次结果保存为基准JSON")
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp(prefix='md2epub-bench-')
+    corpus_dir = args.corpus_dir or os.path.join(temp_dir, 'corpus')
+    try:
+        corpus_bytes = generate_corpus(
+            corpus_dir, args.chapters, args.chapter_size, args.heading_density,
+            args.images, args.tables, args.code_blocks
+        )
+        print(f"语料: {args.chapters} 章，{corpus_bytes / 1024 / 1024:.2f} MB")
+
+        best = None
+        output_path = os.path.join(temp_dir, 'bench.epub')
+        for _ in range(args.repeat):
+            timings = run_benchmark(corpus_dir, output_path, args.highlight)
+            if best is None:
+                best = timings
+            else:
+                best = {stage: min(best[stage], timings[stage]) for stage in STAGES}
+        best['total'] = sum(best[stage] for stage in STAGES)
+        output_size = os.path.getsize(output_path)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    total = best['total']
+    result = {
+        'config': {
+            'chapters': args.chapters,
+            'chapter_size_kb': args.chapter_size,
+            'heading_density': args.heading_density,
+            'images': args.images,
+            'tables': args.tables,
+            'code_blocks': args.code_blocks,
+            'highlight': args.highlight,
+        },
+        'timings': best,
+        'chapters_per_second': args.chapters / total if total else None,
+        'mb_per_second': corpus_bytes / 1024 / 1024 / total if total else None,
+        'peak_memory_mb': peak_memory_mb(),
+        'output_bytes': output_size,
+    }
+
+    for stage in STAGES:
+        share = best[stage] / total * 100 if total else 0
+        print(f"  {stage:<16} {best[stage] * 1000:9.1f} ms  {share:5.1f}%")
+    print(f"  {'total':<16} {total * 1000:9.1f} ms")
+    print(f"吞吐量: {result['chapters_per_second']:.1f} 章/秒，{result['mb_per_second']:.2f} MB/秒")
+    if result['peak_memory_mb'] is not None:
+        print(f"峰值内存: {result['peak_memory_mb']:.1f} MB")
+    print(f"输出大小: {output_size / 1024 / 1024:.2f} MB")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"已保存基准结果: {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != result['config']:
+            print("警告: 基准结果的语料配置与本次不同，比较结果仅供参考")
+        print(f"与基准比较（阈值 {args.threshold * 100:.0f}%）:")
+        if compare_baseline(result, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
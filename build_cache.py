@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import hashlib
+import shutil
+import threading
+
+# 缓存格式版本，修改缓存内容结构时递增，使旧缓存自动失效
+CACHE_VERSION = 5
+
+DEFAULT_CACHE_DIR = '.md2epub-cache'
+DEFAULT_SIZE_LIMIT = 512 * 1024 * 1024  # 512MB
+
+
+def content_hash(*parts):
+    """计算内容哈希，parts可以是字符串或字节串"""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """按块计算文件内容哈希，不把整个文件读入内存"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BuildCache:
+    """基于内容哈希的磁盘构建缓存，按访问时间进行LRU淘汰
+
+    缓存条目按命名空间分目录存放，例如 chapters/ 保存渲染后的章节，
+    条目的修改时间即最近访问时间，超过容量上限时优先删除最久未使用的条目。
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, size_limit=DEFAULT_SIZE_LIMIT):
+        self.cache_dir = cache_dir
+        self.size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, namespace, key):
+        return os.path.join(self.cache_dir, namespace, key[:2], key)
+
+    def get(self, namespace, key):
+        """读取缓存条目，不存在时返回None"""
+        path = self._entry_path(namespace, key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        # 更新访问时间，用于LRU淘汰
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, namespace, key, data):
+        """写入缓存条目，先写临时文件再替换，保证多进程、多线程并发写入时的完整性"""
+        path = self._entry_path(namespace, key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"写入缓存出错: {str(e)}")
+
+    def get_json(self, namespace, key):
+        data = self.get(namespace, key)
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def put_json(self, namespace, key, value):
+        self.put(namespace, key, json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+    def _entries(self):
+        """遍历所有缓存条目，返回(访问时间, 大小, 路径)列表"""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        """返回缓存占用的总字节数"""
+        return sum(size for _, size, _ in self._entries())
+
+    def prune(self):
+        """超过容量上限时按LRU顺序删除条目，返回删除的条目数"""
+        if not self.size_limit:
+            return 0
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.size_limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        """清空缓存目录"""
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+
+def main():
+    """命令行用法: python build_cache.py clear|size [缓存目录]"""
+    if len(sys.argv) < 2 or sys.argv[1] not in ('clear', 'size'):
+        print("用法: python build_cache.py clear|size [缓存目录]")
+        return 1
+
+    cache = BuildCache(sys.argv[2] if len(sys.argv) > 2 else DEFAULT_CACHE_DIR)
+    if sys.argv[1] == 'clear':
+        cache.clear()
+        print(f"已清空缓存: {cache.cache_dir}")
+    else:
+        print(f"缓存大小: {cache.size() / 1024 / 1024:.2f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,9 @@
 import PyInstaller.__main__
 import os
+import sys
 import shutil
 
-def build_exe():
+def build_exe(onefile=False):
     # 清理之前的构建文件
     if os.path.exists('dist'):
         shutil.rmtree('dist')
@@ -10,13 +11,15 @@ def build_exe():
         shutil.rmtree('build')
     
     # 打包参数
+    # 默认打包为目录：单文件模式每次启动都要把所有依赖解压到临时目录，冷启动慢很多
     args = [
         'app.py',                          # 主脚本
         '--name=Markdown2EPUB',            # 可执行文件名称
-        '--onefile',                       # 打包成单个exe文件
+        '--onefile' if onefile else '--onedir',  # 打包成单个exe文件或目录
         '--windowed',                      # 无控制台窗口
         '--clean',                         # 清理临时文件
         '--add-data=requirements.txt;.',   # 包含额外文件
+        '--collect-submodules=markdown',   # Markdown扩展按名称动态导入，需要显式收集
     ]
     
     # 如果有图标文件，添加图标
@@ -28,6 +31,7 @@ def build_exe():
     PyInstaller.__main__.run(args)
     
     print("打包完成，可执行文件在dist目录中。")
+    print("可以运行 python bench_startup.py --frozen dist/Markdown2EPUB/Markdown2EPUB.exe 检查启动耗时。")
 
 if __name__ == "__main__":
-    build_exe()
+    build_exe(onefile='--onefile' in sys.argv[1:])
@@ -27,7 +27,7 @@ def build_mac_app():
         '--noconfirm',                     # 不询问确认
         '--add-data=requirements.txt:.',   # 包含额外文件
         '--add-data=app.py:.',             # 包含主程序
-        '--collect-all=markdownify',       # 确保收集完整的markdownify包
+        '--collect-submodules=markdown',   # Markdown扩展按名称动态导入，需要显式收集
         '--collect-all=ebooklib',          # 确保收集完整的ebooklib包
         '--collect-all=PIL',               # 确保收集PIL/Pillow
         '--osx-bundle-identifier=com.md2epub.app',  # macOS包标识符
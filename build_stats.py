@@ -0,0 +1,127 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+
+# 统计的阶段：读取、Markdown渲染、图片处理、图片优化、目录生成、保存
+STAGES = ('read', 'markdown', 'images', 'optimize', 'toc', 'save')
+
+
+class BuildStats:
+    """一次构建的耗时和计数统计
+
+    记录每个阶段的耗时、每个章节的耗时和大小、读写的字节数、章节缓存命中次数、
+    图片索引的查找次数和图片优化缓存的命中次数。
+    并行渲染时，各子进程的统计合并到主进程，阶段耗时为所有进程的耗时之和。
+    """
+    def __init__(self):
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.chapters = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # 图片查找：索引命中、未命中和实际查询文件系统的次数
+        self.image_index_hits = 0
+        self.image_index_misses = 0
+        self.image_index_probes = 0
+        # 图片优化结果的缓存命中和未命中次数
+        self.image_cache_hits = 0
+        self.image_cache_misses = 0
+        self.images = 0
+        self.total = 0.0
+        # 开启性能分析时为cProfile.Profile，不随统计结果序列化
+        self.profiler = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        return state
+
+    @contextmanager
+    def stage(self, name):
+        """统计with块的耗时，累加到指定阶段"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def add_chapter(self, path, size, seconds, cached=False):
+        self.chapters.append({
+            'path': path,
+            'bytes': size,
+            'seconds': seconds,
+            'cached': cached,
+        })
+
+    def merge(self, other):
+        """合并子进程返回的统计"""
+        for name, seconds in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.chapters.extend(other.chapters)
+        self.bytes_read += other.bytes_read
+        self.bytes_written += other.bytes_written
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+        self.image_index_hits += other.image_index_hits
+        self.image_index_misses += other.image_index_misses
+        self.image_index_probes += other.image_index_probes
+        self.image_cache_hits += other.image_cache_hits
+        self.image_cache_misses += other.image_cache_misses
+        self.images += other.images
+
+    def add_image_index(self, index):
+        """累加文件索引（FileIndex）的查找次数"""
+        self.image_index_hits += index.hits
+        self.image_index_misses += index.misses
+        self.image_index_probes += index.probes
+
+    def slowest_chapters(self, count=5):
+        return sorted(self.chapters, key=lambda chapter: chapter['seconds'], reverse=True)[:count]
+
+    def to_dict(self):
+        return {
+            'total': round(self.total, 4),
+            'stages': {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            'chapters': [dict(chapter, seconds=round(chapter['seconds'], 4)) for chapter in self.chapters],
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+            'image_index_hits': self.image_index_hits,
+            'image_index_misses': self.image_index_misses,
+            'image_index_probes': self.image_index_probes,
+            'image_cache_hits': self.image_cache_hits,
+            'image_cache_misses': self.image_cache_misses,
+            'images': self.images,
+        }
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+    def dump_profile(self, path):
+        """把性能分析结果写入文件，可以用python -m pstats或snakeviz查看"""
+        if self.profiler is None:
+            raise ValueError("构建时没有开启性能分析")
+        self.profiler.dump_stats(path)
+
+    def summary(self):
+        """单行摘要：总耗时、主要阶段耗时和最慢的章节"""
+        parts = [f"总耗时 {self.total:.2f}s"]
+        names = {'read': '读取', 'markdown': '渲染', 'images': '图片', 'optimize': '优化', 'toc': '目录', 'save': '保存'}
+        for name, seconds in self.stages.items():
+            if seconds >= 0.005:
+                parts.append(f"{names.get(name, name)} {seconds:.2f}s")
+        parts.append(f"{len(self.chapters)} 章 {self.bytes_read / 1024 / 1024:.1f} MB")
+        if self.cache_hits or self.cache_misses:
+            parts.append(f"缓存命中 {self.cache_hits}/{self.cache_hits + self.cache_misses}")
+        if self.image_cache_hits or self.image_cache_misses:
+            parts.append(f"图片缓存命中 {self.image_cache_hits}/{self.image_cache_hits + self.image_cache_misses}")
+        if self.image_index_misses:
+            parts.append(f"未找到图片 {self.image_index_misses} 次")
+        slowest = self.slowest_chapters(1)
+        if slowest:
+            parts.append(f"最慢章节 {os.path.basename(slowest[0]['path'])} {slowest[0]['seconds']:.2f}s")
+        return "，".join(parts)
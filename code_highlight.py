@@ -0,0 +1,75 @@
+from collections import OrderedDict
+
+from build_cache import content_hash
+
+# 高亮后的代码块外层的class，生成的CSS以它为前缀
+CSS_CLASS = 'codehilite'
+CSS_FILE = 'style/code.css'
+
+
+class CodeHighlighter:
+    """用Pygments高亮代码块，结果按(语言, 代码, 样式)记忆
+
+    同样的代码片段常在很多章节中重复出现，而高亮是最耗时的渲染步骤。
+    最近使用的结果保存在容量为memo_size的内存LRU中，提供构建缓存时同时保存在磁盘上（highlight/），
+    在多次构建和多个子进程之间共享。没有安装Pygments时available为False，代码块保持原样。
+    """
+    def __init__(self, style='default', cache=None, memo_size=2048):
+        self.style = style
+        self.cache = cache
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        try:
+            from pygments.formatters import HtmlFormatter
+        except ImportError:
+            self.available = False
+            self._formatter = None
+        else:
+            self.available = True
+            # 输出只包含CSS class，不依赖样式，样式只影响生成的CSS
+            self._formatter = HtmlFormatter(cssclass=CSS_CLASS, wrapcode=True)
+
+    def highlight(self, language, code):
+        """返回高亮后的HTML，没有安装Pygments或不认识该语言时返回None"""
+        if not self.available:
+            return None
+        key = content_hash(language, self.style, code)
+        result = self._memo.get(key)
+        if result is not None:
+            self._memo.move_to_end(key)
+            self.hits += 1
+            return result or None
+
+        data = self.cache.get('highlight', key) if self.cache else None
+        if data is not None:
+            result = data.decode('utf-8')
+        else:
+            result = self._render(language, code)
+            if self.cache:
+                self.cache.put('highlight', key, result.encode('utf-8'))
+        self.misses += 1
+
+        # 不认识的语言记为空字符串，同样记忆，避免反复查找词法分析器
+        self._memo[key] = result
+        if len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+        return result or None
+
+    def _render(self, language, code):
+        from pygments import highlight
+        from pygments.lexers import get_lexer_by_name
+        from pygments.util import ClassNotFound
+        try:
+            lexer = get_lexer_by_name(language)
+        except ClassNotFound:
+            return ''
+        return highlight(code, lexer, self._formatter)
+
+    def css(self):
+        """与样式对应的CSS，没有安装Pygments时返回None"""
+        if not self.available:
+            return None
+        from pygments.formatters import HtmlFormatter
+        return HtmlFormatter(style=self.style, cssclass=CSS_CLASS).get_style_defs(f'.{CSS_CLASS}')
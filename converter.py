@@ -1,16 +1,321 @@
 import os
-import markdown
-import ebooklib
 from ebooklib import epub
-from pathlib import Path
+import io
 import re
+import html
+import time
+import uuid
+import pickle
+import hashlib
+import datetime
 import mimetypes
-from bs4 import BeautifulSoup
+from file_index import FileIndex
+from discovery import DEFAULT_INCLUDE, iter_markdown_files
+from build_stats import BuildStats
+from build_cache import BuildCache, CACHE_VERSION, DEFAULT_SIZE_LIMIT, content_hash, file_hash
 
-class EpubConverter:
+# markdown、进程池和流式输出模块只在对应阶段第一次运行时导入，
+# 只导入本模块（例如取得ConversionCancelled）不会加载它们
+
+# 默认的Markdown扩展，实际使用的扩展列表同时作为缓存键的一部分
+MARKDOWN_EXTENSIONS = ['extra', 'toc']
+
+# 可重现构建的默认时间戳（1980-01-01，zip格式能表示的最早时间），可以用SOURCE_DATE_EPOCH环境变量指定
+REPRODUCIBLE_EPOCH = 315532800
+
+
+class ConversionCancelled(Exception):
+    """转换被用户取消"""
+
+
+class _ItemCollector:
+    """在子进程中代替EpubBook收集条目，回到主进程后再按顺序加入书籍"""
     def __init__(self):
+        self.items = []
+    
+    def add_item(self, item):
+        self.items.append(item)
+        return item
+
+
+class _WorkerBook:
+    """子进程内一本书的状态：文件索引和已经随结果返回给主进程的图片"""
+    def __init__(self, image_index):
+        self.image_index = image_index
+        self.image_registry = {}
+        self.image_hrefs = set()
+
+
+# 子进程内复用的转换器（按配置区分）和每本书的状态（按书籍标识区分），进程池可以在多本书之间共享，
+# 交替构建的几本书各自复用自己的文件索引；新书使用新建的索引，之后新增的图片才能被找到。
+# 只保留最近使用的WORKER_BOOKS本书
+WORKER_BOOKS = 8
+_worker_converters = {}
+_worker_books = {}
+
+
+def _init_worker(image_index, book_token=None):
+    """进程池初始化：使用主进程已经建立的文件索引，避免子进程重复扫描目录"""
+    _worker_books[book_token] = _WorkerBook(image_index)
+
+
+def _get_worker_book(book_token):
+    """返回子进程内这本书的状态，没有时新建，并淘汰最久没有使用的书"""
+    book = _worker_books.pop(book_token, None)
+    if book is None:
+        book = _WorkerBook(FileIndex())
+    # 字典按插入顺序排列，重新插入即移到最近使用的位置
+    _worker_books[book_token] = book
+    while len(_worker_books) > WORKER_BOOKS:
+        del _worker_books[next(iter(_worker_books))]
+    return book
+
+
+def _get_worker_converter(options):
+    """返回子进程内与配置对应的转换器，同一配置只创建一次，从而复用Markdown解析器"""
+    key = pickle.dumps(options)
+    converter = _worker_converters.get(key)
+    if converter is None:
+        converter = EpubConverter(**options)
+        _worker_converters[key] = converter
+    return converter
+
+
+def _render_chapter_job(md_path, options, images_dir, book_token, chapter_root=None):
+    """进程池任务：渲染单个章节，返回HTML内容、标题列表、锚点和链接、需要加入书籍的图片条目、索引统计和构建统计"""
+    book = _get_worker_book(book_token)
+    converter = _get_worker_converter(options)
+    # 每本书的图片分别登记，换书时未登记的图片才会随结果返回给主进程
+    converter.image_registry = book.image_registry
+    converter._image_hrefs = book.image_hrefs
+    converter.images_dir = images_dir
+    converter.chapter_root = chapter_root
+    converter.image_index = book.image_index
+    converter.book = _ItemCollector()
+    converter._pending_images = []
+    converter._pending_remote = []
+    converter.image_index.reset_stats()
+    converter.stats = BuildStats()
+    html_content, headings, refs = converter.render_markdown_file(md_path)
+    index = converter.image_index
+    return html_content, headings, refs, converter.book.items, (index.hits, index.misses, index.probes), converter.stats
+
+
+def segment_file_name(name, index):
+    """章节分段的文件名：第一段为name.xhtml，之后为name-part2.xhtml、name-part3.xhtml……"""
+    if index == 0:
+        return f'{name}.xhtml'
+    return f'{name}-part{index + 1}.xhtml'
+
+
+def flatten_toc_tokens(toc_tokens, max_level=6):
+    """将toc扩展生成的标题树按文档顺序展开为(级别, 文本, ID)列表，只保留不超过max_level的标题
+    
+    渲染时保留全部级别，目录的深度在生成目录时再决定。
+    """
+    headings = []
+    stack = list(reversed(toc_tokens))
+    while stack:
+        token = stack.pop()
+        if token['level'] <= max_level:
+            headings.append((token['level'], html.unescape(token['name']), token['id']))
+        stack.extend(reversed(token['children']))
+    return headings
+
+
+def toc_uid(href):
+    """目录项的ID：由链接地址生成，以字母开头，只包含XML ID允许的字符
+    
+    其他字符和_写作_十六进制码_，不同的链接地址得到不同的ID。
+    """
+    return 'toc_' + re.sub(r'[^\w.-]|_', lambda match: f'_{ord(match.group()):x}_', href)
+
+
+def finish_toc(nodes):
+    """把[(Link, 子项列表)]转换为ebooklib的目录结构：有子项的为(Section, 子项)，没有的为Link"""
+    items = []
+    for link, children in nodes:
+        if children:
+            items.append((epub.Section(link.title, link.href), finish_toc(children)))
+        else:
+            items.append(link)
+    return items
+
+
+class EpubConverter:
+    def __init__(self, workers=None, cache_dir=None, cache_size_limit=DEFAULT_SIZE_LIMIT, extensions=None,
+                 streaming=False, dedupe_images_by_content=False, image_pipeline=None, executor=None,
+                 progress=None, profile=False, split_level=None, split_size=0, reproducible=False,
+                 compress_level=6, store_media=True, compression_workers=None, include=None, exclude=None,
+                 remote_images=False, remote_workers=8, remote_timeout=10, highlight=False,
+                 highlight_style='default', toc_depth=3, toc_max_entries=None):
         self.book = None
         self.images_dir = None
+        # 进度回调 progress(阶段, 当前数量, 总数, 说明)，阶段为chapter、image、optimize、toc或save，
+        # 总数未知时为None；回调可能在转换线程中调用
+        self.progress = progress
+        self._cancelled = False
+        self._chapter_total = None
+        self._progress_counts = {}
+        # 本次构建的耗时和计数统计，profile为True时同时用cProfile记录整个构建
+        self.stats = BuildStats()
+        self.profile = profile
+        # 并行渲染章节使用的进程数，None或1表示串行处理
+        self.workers = workers
+        # 外部提供的进程池（例如批量构建多本书时共享），提供时忽略workers
+        self.executor = executor
+        # 每次构建结束后是否按容量上限清理缓存，批量构建时可以只在最后清理一次
+        self.prune_cache_after_build = True
+        # 构建缓存，cache_dir为None时不使用缓存
+        self.cache = BuildCache(cache_dir, cache_size_limit) if cache_dir else None
+        # Markdown扩展列表，解析器在首次使用时创建并在章节之间复用
+        self.extensions = list(extensions) if extensions is not None else list(MARKDOWN_EXTENSIONS)
+        self._md = None
+        self._image_extension = None
+        # 代码高亮：highlight为True时用Pygments（可选依赖）高亮标明了语言的代码块，
+        # 结果按代码内容记忆；样式表style/code.css与style/nav.css一起加入书籍
+        self.highlight = highlight
+        self.highlight_style = highlight_style
+        self.highlighter = None
+        self._highlight_extension = None
+        # 大章节分段：split_level为1时在顶层h1处切分，为2时在h1和h2处切分，None表示不切分；
+        # 只切分Markdown源文件不小于split_size字节的章节
+        self.split_level = split_level
+        self.split_size = split_size
+        self._chapter_extension = None
+        # 可重现构建：标识符由内容决定，修改时间和zip时间戳固定，图片按内容命名，
+        # 相同的输入得到字节相同的EPUB
+        self.reproducible = reproducible
+        # 压缩策略：文本条目按compress_level（0-9）进行deflate压缩；store_media为True时
+        # JPEG、PNG、字体等本身已经压缩的文件直接存储，不再浪费时间压缩；
+        # compression_workers大于1时用多个线程并行准备要写入的条目
+        self.compress_level = compress_level
+        self.store_media = store_media
+        self.compression_workers = compression_workers
+        # 目录转换时收录的章节文件（glob，包含/时匹配相对路径，否则匹配文件名），子目录递归发现；
+        # 子目录中的章节文件名包含相对路径，目录中按子目录组织为Section
+        self.include = tuple(include) if include else DEFAULT_INCLUDE
+        self.exclude = tuple(exclude) if exclude else ()
+        self.chapter_root = None
+        # 流式输出：章节和图片在生成时立即写入输出文件，图片不读入内存
+        self.streaming = streaming
+        self.stream = None
+        # 流式输出且切分章节时，链接指向尚未渲染的章节中锚点的章节文件暂不写入，
+        # 等目标章节加入、知道锚点所在的分段后再改写链接并写入
+        self._held_items = []
+        # 统计写入字节数：输出文件对象开始写入时的位置，不能定位的流则为计数包装
+        self._output_start = None
+        self._output_counter = None
+        # 图片登记表：解析后的图片路径 -> EPUB中的路径，保证每张图片只读取和存储一次
+        # dedupe_images_by_content为True时，内容相同的不同文件也只存储一份
+        self.dedupe_images_by_content = dedupe_images_by_content
+        self.image_registry = {}
+        self._image_hrefs = set()
+        # 图片查找使用的文件索引，目录只扫描一次
+        self.image_index = FileIndex()
+        # 图片优化流水线（ImagePipeline），需要优化的图片在保存前统一处理
+        self.image_pipeline = image_pipeline
+        self._pending_images = []
+        # 自动生成的目录包含h1到h{toc_depth}的标题；目录项总数超过toc_max_entries时
+        # 从最深的级别开始逐级省略，避免超大的API参考生成阅读器难以加载的目录
+        self.toc_depth = toc_depth
+        self.toc_max_entries = toc_max_entries
+        self._toc_level = None
+        # 网络图片：remote_images为True时并发下载http/https图片并嵌入书籍（启用构建缓存时缓存在磁盘上），
+        # 否则保留原始链接；下载器在主进程中第一次创建书籍时创建，构建期间复用连接，
+        # 每次构建结束时关闭线程池和连接（之后的构建会按需重新创建）
+        self.remote_images = remote_images
+        self.remote_workers = remote_workers
+        self.remote_timeout = remote_timeout
+        self.remote_fetcher = None
+        self._pending_remote = []
+        # 内存转换时的图片回调 image_resolver(src)，返回图片内容或None；
+        # 内存转换期间_in_memory为True，没有回调时图片引用保持原样，不访问文件系统
+        self.image_resolver = None
+        self._in_memory = False
+    
+    def _worker_options(self):
+        """传递给子进程的构造参数，使子进程的渲染配置与主进程一致"""
+        return {
+            'cache_dir': self.cache.cache_dir if self.cache else None,
+            'cache_size_limit': self.cache.size_limit if self.cache else DEFAULT_SIZE_LIMIT,
+            'extensions': self.extensions,
+            'streaming': self.streaming,
+            'dedupe_images_by_content': self.dedupe_images_by_content,
+            'image_pipeline': self.image_pipeline,
+            'split_level': self.split_level,
+            'split_size': self.split_size,
+            'reproducible': self.reproducible,
+            'compress_level': self.compress_level,
+            'store_media': self.store_media,
+            'compression_workers': self.compression_workers,
+            'include': self.include,
+            'exclude': self.exclude,
+            'remote_images': self.remote_images,
+            'remote_workers': self.remote_workers,
+            'remote_timeout': self.remote_timeout,
+            'highlight': self.highlight,
+            'highlight_style': self.highlight_style,
+            'toc_depth': self.toc_depth,
+            'toc_max_entries': self.toc_max_entries,
+        }
+    
+    def get_markdown_parser(self):
+        """返回复用的Markdown解析器，每次使用前重置其状态"""
+        if self._md is None:
+            import markdown
+            from md_extensions import ImageSrcExtension, ChapterExtension, HighlightExtension
+            
+            # 图片地址改写、分段与链接和代码高亮扩展总是启用，不属于可配置的扩展列表
+            self._image_extension = ImageSrcExtension()
+            self._chapter_extension = ChapterExtension()
+            self._highlight_extension = HighlightExtension()
+            self._md = markdown.Markdown(
+                extensions=self.extensions + [self._image_extension, self._chapter_extension,
+                                              self._highlight_extension]
+            )
+        return self._md.reset()
+    
+    def get_highlighter(self):
+        """返回代码高亮器，未开启高亮或没有安装Pygments时返回None"""
+        if not self.highlight:
+            return None
+        if self.highlighter is None:
+            from code_highlight import CodeHighlighter
+            self.highlighter = CodeHighlighter(self.highlight_style, self.cache)
+            if not self.highlighter.available:
+                print("未安装Pygments，代码块不会高亮（pip install pygments）")
+        return self.highlighter if self.highlighter.available else None
+    
+    def cancel(self):
+        """请求取消正在进行的转换，可以从其他线程调用，转换会在下一个进度点停止"""
+        self._cancelled = True
+    
+    def _report(self, stage, total=None, message=''):
+        """报告进度并检查是否已取消，每次调用使该阶段的计数加一"""
+        if self._cancelled:
+            raise ConversionCancelled("转换已取消")
+        current = self._progress_counts.get(stage, 0) + 1
+        self._progress_counts[stage] = current
+        if self.progress:
+            self.progress(stage, current, total, message)
+    
+    def clone(self):
+        """创建配置相同、构建状态独立的转换器，共享进程池、进度回调和缓存目录"""
+        converter = EpubConverter(
+            workers=self.workers,
+            executor=self.executor,
+            progress=self.progress,
+            profile=self.profile,
+            **self._worker_options()
+        )
+        converter.prune_cache_after_build = self.prune_cache_after_build
+        return converter
+    
+    def clear_cache(self):
+        """清空构建缓存"""
+        if self.cache:
+            self.cache.clear()
     
     def create_book(self, title, author, cover_path=None):
         """创建新的EPUB书籍"""
@@ -18,105 +323,652 @@ class EpubConverter:
         self.book.set_title(title)
         self.book.set_language('zh-CN')
         self.book.add_author(author)
+        self.image_registry = {}
+        self._image_hrefs = set()
+        self.image_index = FileIndex()
+        self._pending_images = []
+        self._cancelled = False
+        self._chapter_total = None
+        self._progress_counts = {}
+        self.stats = BuildStats()
+        self.image_resolver = None
+        self.chapter_root = None
+        self._toc_level = None
+        self._pending_remote = []
+        self._held_items = []
+        # 全书的锚点索引：章节文件 -> 其中的元素ID；链接索引：章节文件 -> [(目标文件, 锚点)]；
+        # 章节文件 -> 同一章节的全部分段文件
+        self.anchor_index = {}
+        self.link_index = {}
+        self._chapter_files = {}
+        self.dangling_links = []
+        if self.remote_images:
+            if self.remote_fetcher is None:
+                from remote_images import RemoteImageFetcher
+                self.remote_fetcher = RemoteImageFetcher(
+                    cache_dir=self.cache.cache_dir if self.cache else None,
+                    cache_size_limit=self.cache.size_limit if self.cache else DEFAULT_SIZE_LIMIT,
+                    max_workers=self.remote_workers,
+                    timeout=self.remote_timeout
+                )
+            self.remote_fetcher.forget()
         
         if cover_path and os.path.exists(cover_path):
             self.book.set_cover('cover.jpg', open(cover_path, 'rb').read())
     
+    def open_stream(self, output_path):
+        """开启流式输出，之后加入书籍的章节和图片会立即写入输出文件"""
+        if not self.book:
+            raise ValueError("请先创建书籍")
+        
+        self._ensure_output_dir(output_path)
+        from epub_stream import StreamingEpubWriter
+        self.stream = StreamingEpubWriter(self._output_target(output_path), self.book, self._write_options())
+    
+    def _output_target(self, output_path):
+        """返回实际写入的目标并记录统计写入字节数的起点
+
+        可定位的文件对象记录写入前的位置（其中可能已有其他内容），
+        只有write的流包装为CountingWriter计数。
+        """
+        self._output_start = self._output_counter = None
+        if isinstance(output_path, (str, os.PathLike)):
+            return output_path
+        seekable = getattr(output_path, 'seekable', None)
+        if seekable and seekable():
+            self._output_start = output_path.tell()
+            return output_path
+        from epub_stream import CountingWriter
+        self._output_counter = CountingWriter(output_path)
+        return self._output_counter
+    
+    def _output_size(self, output_path):
+        """本次写入输出的字节数"""
+        if isinstance(output_path, (str, os.PathLike)):
+            return os.path.getsize(output_path)
+        if self._output_counter is not None:
+            return self._output_counter.bytes_written
+        return output_path.tell() - self._output_start
+    
+    def _write_options(self):
+        """EPUB写入选项：压缩策略和是否生成page-list，可重现构建时还包括固定的修改时间和zip时间戳"""
+        from epub_stream import STORED_EXTENSIONS
+        options = {
+            'compresslevel': self.compress_level,
+            'store_extensions': STORED_EXTENSIONS if self.store_media else (),
+            'compression_workers': self.compression_workers,
+            # 生成page-list需要把每个章节再解析三遍查找epub:type标记，
+            # Markdown生成的章节没有这种标记，只在章节中确实出现时才生成
+            'epub3_pages': any(
+                isinstance(item, epub.EpubHtml) and isinstance(item.content, str) and 'epub:type' in item.content
+                for item in self.book.get_items()
+            ),
+        }
+        if self.reproducible:
+            epoch = max(int(os.environ.get('SOURCE_DATE_EPOCH', REPRODUCIBLE_EPOCH)), REPRODUCIBLE_EPOCH)
+            mtime = datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc)
+            options.update(mtime=mtime, zip_date_time=mtime.timetuple()[:6])
+        return options
+    
+    def _content_identifier(self):
+        """根据书籍元数据和全部条目内容计算标识符，相同的输入得到相同的标识符"""
+        h = hashlib.sha256()
+        # 设置封面时ebooklib在None命名空间下添加元数据，按字符串排序
+        for namespace, values in sorted(self.book.metadata.items(), key=lambda pair: str(pair[0])):
+            for name, entries in sorted(values.items(), key=lambda pair: str(pair[0])):
+                if name != 'identifier':
+                    h.update(repr((namespace, name, entries)).encode('utf-8'))
+        
+        # 按文件名排序，与条目加入书籍的顺序无关（监视模式增量更新后的书籍与完整构建相同）
+        for item in sorted(self.book.get_items(), key=lambda item: item.file_name):
+            # 目录和导航由其他条目生成；流式输出时已写入的条目内容已释放，由写入器的哈希代替
+            if isinstance(item, (epub.EpubNcx, epub.EpubNav)) or (self.stream and self.stream.is_written(item)):
+                continue
+            content = item.content
+            h.update(item.file_name.encode('utf-8'))
+            h.update(content if isinstance(content, bytes) else content.encode('utf-8'))
+        if self.stream:
+            h.update(self.stream.digest.digest())
+        return f'urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, h.hexdigest())}'
+    
+    @staticmethod
+    def _ensure_output_dir(output_path):
+        """确保输出目录存在，输出可以是不包含目录的文件名或文件对象"""
+        if isinstance(output_path, (str, os.PathLike)):
+            output_dir = os.path.dirname(output_path)
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+    
+    def _add_item(self, item):
+        """添加条目到书籍，流式输出时立即写入并释放内容"""
+        self.book.add_item(item)
+        if isinstance(item, epub.EpubHtml):
+            if getattr(item, 'segment_of', None) is None:
+                self._report('chapter', self._chapter_total, item.file_name)
+        else:
+            self._report('image', None, item.file_name)
+        
+        if getattr(item, 'remote_url', None):
+            # 网络图片在后台下载，写入前由download_remote_images填入内容；
+            # 子进程中没有下载器，只登记图片，由主进程加入书籍时开始下载
+            self._pending_remote.append(item)
+            if self.remote_fetcher is not None:
+                self.remote_fetcher.submit(item.remote_url)
+        elif getattr(item, 'optimize', False):
+            # 需要优化的图片在保存前统一交给图片流水线处理
+            self._pending_images.append(item)
+        elif self.stream and self._links_pending(item):
+            self._held_items.append(item)
+        elif self.stream:
+            if isinstance(item, epub.EpubHtml) and self._pending_remote:
+                # 章节写入后无法修改，先等待它引用的网络图片下载完成
+                self.download_remote_images()
+            source_path = getattr(item, 'source_path', None)
+            if source_path:
+                self.stream.write_file(item, source_path)
+            else:
+                self.stream.write_item(item)
+        return item
+    
     def add_markdown_file(self, md_path, custom_toc=None):
         """添加Markdown文件到EPUB"""
         if not self.book:
             raise ValueError("请先创建书籍")
         
-        # 读取Markdown内容
-        with open(md_path, 'r', encoding='utf-8') as f:
-            md_content = f.read()
+        html_content, headings, refs = self.render_markdown_file(md_path)
+        return self._add_chapter(md_path, html_content, headings, refs)
+    
+    def render_markdown_file(self, md_path):
+        """读取并渲染Markdown文件，处理其中的图片，返回HTML内容、标题列表和锚点与链接（见render_markdown）"""
+        stats = self.stats
+        start = time.perf_counter()
+        cache_hits = stats.cache_hits
         
-        # 转换Markdown为HTML，添加toc扩展以生成ID
-        html_content = markdown.markdown(md_content, extensions=['extra', 'toc'])
+        # 读取Markdown内容
+        with stats.stage('read'):
+            with open(md_path, 'r', encoding='utf-8') as f:
+                size = os.fstat(f.fileno()).st_size
+                md_content = f.read()
+        stats.bytes_read += size
         
-        # 如果存在图片，处理图片（先从文档目录查找，再从指定图片目录查找）
+        # 图片在渲染时处理（先从文档目录查找，再从指定图片目录查找），耗时单独计入images阶段
         md_dir = os.path.dirname(md_path)  # 保存Markdown文档所在目录
-        html_content = self.process_images(html_content, md_dir)
+        images_time = stats.stages['images']
+        render_start = time.perf_counter()
+        html_content, headings, refs = self.render_markdown(md_content, md_dir, self.chapter_name(md_path), size)
+        stats.stages['markdown'] += time.perf_counter() - render_start - (stats.stages['images'] - images_time)
         
-        # 创建章节
-        file_name = os.path.basename(md_path).replace('.md', '')
+        stats.add_chapter(md_path, size, time.perf_counter() - start, stats.cache_hits > cache_hits)
+        return html_content, headings, refs
+    
+    def render_markdown(self, md_content, md_dir=None, name=None, size=None):
+        """将Markdown转换为HTML并提取标题，图片地址和章节之间的链接在渲染时改写，内容未变化时直接使用缓存结果
+        
+        开启分段且提供了章节文件名name时，HTML中包含分段标记，由_add_chapter切分；
+        是否切分按Markdown源文件的字节数size判断，不提供时按UTF-8编码计算。
+        返回(HTML, 标题列表, 锚点与链接)，锚点与链接为{'anchors': 每个分段的元素ID,
+        'links': 每个分段的站内链接[(文件, 锚点)]}，由_add_chapter加入全书索引。
+        """
+        if self.split_level and name and size is None:
+            size = len(md_content.encode('utf-8'))
+        split = bool(self.split_level and name and size >= self.split_size)
+        split_key = f'{self.split_level}:{name}' if split else ''
+        highlighter = self.get_highlighter()
+        highlight_key = self.highlight_style if highlighter else ''
+        
+        if not self._in_memory:
+            self._index_image_dirs(md_dir)
+        
+        cache_key = None
+        if self.cache:
+            cache_key = content_hash(str(CACHE_VERSION), ','.join(self.extensions), split_key, highlight_key, md_content)
+            cached = self.cache.get_json('chapters', cache_key)
+            # 缓存的HTML中图片地址和链接已经改写，每张图片的查找结果和每个链接的目标都不变时才能直接使用
+            if (cached is not None and self._restore_images(cached['images'], md_dir)
+                    and all(self.chapter_link(href, md_dir) == new_href for href, new_href in cached['rewrites'])):
+                self.stats.cache_hits += 1
+                refs = {
+                    'anchors': cached['anchors'],
+                    'links': [[tuple(link) for link in links] for links in cached['links']],
+                }
+                return cached['html'], [tuple(heading) for heading in cached['headings']], refs
+            self.stats.cache_misses += 1
+        
+        # 转换Markdown为HTML，toc扩展在渲染时生成标题ID和标题树
+        md = self.get_markdown_parser()
+        self._image_extension.rewrite = lambda img_src: self.rewrite_image_src(img_src, md_dir)
+        chapter_extension = self._chapter_extension
+        chapter_extension.level = self.split_level if split else None
+        chapter_extension.segment_name = lambda index: segment_file_name(name, index)
+        chapter_extension.rewrite_link = lambda href: self.chapter_link(href, md_dir)
+        self._highlight_extension.highlight = highlighter.highlight if highlighter else None
+        html_content = md.convert(md_content)
+        headings = flatten_toc_tokens(getattr(md, 'toc_tokens', []))
+        refs = {'anchors': chapter_extension.anchors, 'links': chapter_extension.links}
+        
+        if self.cache:
+            self.cache.put_json('chapters', cache_key, {
+                'html': html_content,
+                'headings': headings,
+                'images': self._image_extension.images,
+                'rewrites': chapter_extension.rewrites,
+                'anchors': refs['anchors'],
+                'links': refs['links'],
+            })
+        return html_content, headings, refs
+    
+    def _restore_images(self, images, md_dir):
+        """重新登记缓存章节引用的图片，任何一张图片的查找结果变化时返回False"""
+        for img_src, href in images:
+            if self.rewrite_image_src(img_src, md_dir) != href:
+                return False
+        return True
+    
+    def _relative_parts(self, md_path):
+        """章节相对于chapter_root的路径各部分，不在chapter_root下时只有文件名"""
+        if self.chapter_root:
+            rel_path = os.path.relpath(md_path, self.chapter_root)
+            if not rel_path.startswith(os.pardir):
+                return rel_path.split(os.sep)
+        return [os.path.basename(md_path)]
+    
+    def chapter_name(self, md_path):
+        """章节文件名（不含扩展名），由相对路径决定，不同的章节文件不会同名
+        
+        子目录中的章节以相对路径命名，各部分用~-连接，部分中原有的~写作~~，
+        例如guide/intro.md为guide~-intro，不会与guide-intro.md（guide-intro）冲突。
+        """
+        parts = self._relative_parts(md_path)
+        if parts[-1].endswith('.md'):
+            parts[-1] = parts[-1][:-len('.md')]
+        return '~-'.join(part.replace('~', '~~') for part in parts)
+    
+    def _add_chapter(self, md_path, html_content, headings=None, refs=None):
+        """根据渲染好的HTML创建章节并添加到书籍，HTML中有分段标记时切分为多个文件"""
+        from md_extensions import SPLIT_MARKER
+        
+        # 创建章节，子目录中的章节记录所在的子目录，用于生成目录中的Section
+        file_name = self.chapter_name(md_path)
+        parts = self._relative_parts(md_path)
+        title = parts[-1].replace('.md', '')
+        segments = html_content.split(SPLIT_MARKER)
         chapter = epub.EpubHtml(
-            title=str(file_name),  # 确保标题是字符串
-            file_name=f'{file_name}.xhtml'
+            title=str(title),  # 确保标题是字符串
+            file_name=segment_file_name(file_name, 0)
         )
-        chapter.content = html_content
+        chapter.section = tuple(parts[:-1])
+        chapter.content = segments[0]
+        
+        # 其余分段作为独立的文件紧跟在章节之后，记录每个分段开头的标题ID
+        chapter.segments = []
+        starts = {}
+        for index, segment in enumerate(segments[1:], 1):
+            heading_id, _, content = segment.partition('-->')
+            part = epub.EpubHtml(title=str(title), file_name=segment_file_name(file_name, index))
+            part.content = content
+            part.segment_of = chapter
+            chapter.segments.append(part)
+            starts[heading_id] = part.file_name
         
-        # 存储原始内容，用于后续提取标题
-        chapter.original_content = html_content
+        # 存储渲染时提取的标题，用于后续生成目录
         chapter.file_path = md_path
+        if headings is not None:
+            chapter.headings = headings
+            if starts:
+                # 标题按文档顺序排列，遇到分段开头的标题时切换到下一个分段文件
+                chapter.heading_files = {}
+                current = chapter.file_name
+                for _, _, heading_id in headings:
+                    current = starts.get(heading_id, current)
+                    chapter.heading_files[heading_id] = current
+        
+        if self.get_highlighter():
+            from code_highlight import CSS_FILE
+            for item in [chapter] + chapter.segments:
+                item.add_link(href=CSS_FILE, rel='stylesheet', type='text/css')
+        
+        # 流式输出时章节写入后内容即被释放，先记录锚点和链接
+        self.index_chapter(chapter, refs)
+        if self.stream:
+            for item in [chapter] + chapter.segments:
+                self._retarget_known_links(item)
         
         # 添加章节到书籍
-        self.book.add_item(chapter)
+        self._add_item(chapter)
+        for part in chapter.segments:
+            self._add_item(part)
+        if self._held_items:
+            self._write_held_items()
         return chapter
     
-    def process_images(self, html_content, md_dir=None):
-        """处理HTML中的图片引用，优先从Markdown文档目录查找，再从指定图片目录查找"""
-        img_pattern = re.compile(r'<img[^>]+src="([^"]+)"[^>]*>')
+    def chapter_link(self, href, md_dir=None):
+        """指向其他Markdown文件的链接（other.md#id）对应的章节文件链接（other.xhtml#id），其他链接返回None
         
-        def replace_img(match):
-            img_src = match.group(1)
-            
-            # 如果是网络URL，直接保留
-            if img_src.startswith(('http://', 'https://')):
-                return match.group(0)
-            
-            # 检查是否为绝对路径
-            if os.path.isabs(img_src):
-                # 如果是绝对路径且文件存在，添加到EPUB
-                if os.path.exists(img_src):
-                    return self.add_image_to_epub(img_src, match.group(0))
+        目标章节的文件名由其路径决定，不需要等它渲染；锚点位于哪个分段以及目标是否存在，
+        在保存前由check_links按全书的锚点索引检查。
+        """
+        from urllib.parse import unquote
+        path, sep, fragment = href.partition('#')
+        if not path.lower().endswith('.md') or '://' in path or path.startswith('mailto:'):
+            return None
+        target = os.path.normpath(os.path.join(md_dir or '', unquote(path)))
+        return segment_file_name(self.chapter_name(target), 0) + sep + fragment
+    
+    def index_chapter(self, chapter, refs=None):
+        """把渲染时收集的锚点和站内链接（见render_markdown）加入全书索引，重新渲染的章节需要再次调用"""
+        files = [chapter] + getattr(chapter, 'segments', [])
+        names = [item.file_name for item in files]
+        anchors = refs['anchors'] if refs else [()] * len(files)
+        links = refs['links'] if refs else [()] * len(files)
+        for item, item_anchors, item_links in zip(files, anchors, links):
+            self.anchor_index[item.file_name] = set(item_anchors)
+            self.link_index[item.file_name] = [(path or item.file_name, fragment) for path, fragment in item_links]
+            self._chapter_files[item.file_name] = names
+    
+    def unindex_chapter(self, chapter):
+        """从全书索引中移除章节和它的分段"""
+        for item in [chapter] + getattr(chapter, 'segments', []):
+            self.anchor_index.pop(item.file_name, None)
+            self.link_index.pop(item.file_name, None)
+            self._chapter_files.pop(item.file_name, None)
+    
+    def locate_anchor(self, file_name, fragment):
+        """在全书索引中查找锚点，返回锚点实际所在的文件（可能是章节的另一个分段），找不到时返回None"""
+        if file_name not in self.anchor_index:
+            return None
+        if not fragment or fragment in self.anchor_index[file_name]:
+            return file_name
+        for other in self._chapter_files.get(file_name, ()):
+            if fragment in self.anchor_index[other]:
+                return other
+        return None
+    
+    def check_links(self):
+        """按全书的锚点索引检查所有站内链接，一次遍历所有链接
+        
+        锚点位于目标章节的其他分段时改为指向该分段（流式输出时章节已经写入，只能报告），
+        目标文件或锚点不存在的链接记录在dangling_links中，返回其数量。
+        """
+        self.dangling_links = []
+        for source, links in list(self.link_index.items()):
+            fixes = {}
+            for target, fragment in links:
+                found = self.locate_anchor(target, fragment)
+                href = f'{target}#{fragment}' if fragment else target
+                if found == target:
+                    continue
+                if found is None or self.stream is not None:
+                    self.dangling_links.append((source, href))
+                else:
+                    fixes[href] = f'{found}#{fragment}'
+            if fixes:
+                self._retarget_links(self.book.get_item_with_href(source), fixes)
+        return len(self.dangling_links)
+    
+    def _retarget_known_links(self, item):
+        """流式输出时章节写入后不能再修改，写入前先改写指向已知分段中锚点的链接"""
+        fixes = {}
+        for target, fragment in self.link_index[item.file_name]:
+            found = self.locate_anchor(target, fragment)
+            if found is not None and found != target:
+                fixes[f'{target}#{fragment}'] = f'{found}#{fragment}'
+        if fixes:
+            self._retarget_links(item, fixes)
+    
+    def _links_pending(self, item):
+        """章节文件是否有链接指向尚未加入的章节中的锚点：切分章节时锚点可能位于目标章节的其他分段"""
+        if not self.split_level or not isinstance(item, epub.EpubHtml):
+            return False
+        return any(fragment and target not in self.anchor_index
+                   for target, fragment in self.link_index.get(item.file_name, ()))
+    
+    def _write_held_items(self, final=False):
+        """写入链接目标都已加入的暂存章节文件，final为True时写入全部（剩余的链接由check_links报告）"""
+        held = self._held_items
+        self._held_items = []
+        for item in held:
+            if not final and self._links_pending(item):
+                self._held_items.append(item)
+                continue
+            self._retarget_known_links(item)
+            if self._pending_remote:
+                self.download_remote_images()
+            self.stream.write_item(item)
+    
+    def _retarget_links(self, item, fixes):
+        """把章节文件中的链接按fixes（原链接 -> 新链接）改写，并更新链接索引
+        
+        只有链接指向其他分段中的锚点时才需要，多数章节不会经过这一步。
+        """
+        from md_extensions import RAW_LINK_HREF
+        file_name = item.file_name
+        
+        def retarget(match):
+            path, _, fragment = html.unescape(match.group(3)).partition('#')
+            new_href = fixes.get(f'{path or file_name}#{fragment}')
+            if new_href is None:
                 return match.group(0)
+            return f'{match.group(1)}{match.group(2)}{html.escape(new_href)}{match.group(2)}'
+        
+        item.content = RAW_LINK_HREF.sub(retarget, item.content)
+        links = []
+        for target, fragment in self.link_index[file_name]:
+            new_href = fixes.get(f'{target}#{fragment}')
+            links.append((new_href.partition('#')[0], fragment) if new_href else (target, fragment))
+        self.link_index[file_name] = links
+    
+    def process_images(self, html_content, md_dir=None):
+        """改写HTML字符串中的图片引用，用于没有经过render_markdown的HTML"""
+        from md_extensions import rewrite_raw_img_src
+        self._index_image_dirs(md_dir)
+        return rewrite_raw_img_src(html_content, lambda img_src: self.rewrite_image_src(img_src, md_dir))
+    
+    def _index_image_dirs(self, md_dir):
+        """首次遇到的图片目录和章节目录扫描一次加入索引，之后的图片查找都在内存中完成
+        
+        只扫描目录转换的章节根目录，文档不在其中时（例如单个文件的父目录）不扫描，
+        图片查找直接查询文件系统，避免为一张图片遍历整个目录树。
+        """
+        self.image_index.add_root(self.images_dir)
+        if md_dir and self.chapter_root:
+            if not os.path.relpath(md_dir, self.chapter_root).startswith(os.pardir):
+                self.image_index.add_root(self.chapter_root)
+    
+    def rewrite_image_src(self, img_src, md_dir=None):
+        """查找图片并登记到书籍，返回EPUB中的图片路径，网络图片或找不到图片时返回None"""
+        with self.stats.stage('images'):
+            if self._in_memory:
+                # 内存转换：图片内容由回调提供，不访问文件系统，没有回调时保持原样
+                if self.image_resolver is None:
+                    return None
+                try:
+                    data = self.image_resolver(img_src)
+                    return self.register_image_data(img_src, data) if data is not None else None
+                except Exception as e:
+                    print(f"添加图片出错: {str(e)}")
+                    return None
             
-            # 如果是相对路径，先尝试从Markdown文档目录查找
-            img_found = False
-            
-            if md_dir:
-                md_img_path = os.path.normpath(os.path.join(md_dir, img_src))
-                if os.path.exists(md_img_path):
-                    return self.add_image_to_epub(md_img_path, match.group(0))
+            if self.remote_images and img_src.startswith(('http://', 'https://')):
+                return self.register_remote_image(img_src)
             
-            # 如果在文档目录没找到，再尝试从指定图片目录查找
-            if self.images_dir:
-                img_path = os.path.normpath(os.path.join(self.images_dir, img_src))
-                if os.path.exists(img_path):
-                    return self.add_image_to_epub(img_path, match.group(0))
-                
-                # 尝试直接在images_dir根目录查找图片文件名（不考虑子目录）
-                img_filename = os.path.basename(img_src)
-                img_path = os.path.normpath(os.path.join(self.images_dir, img_filename))
-                if os.path.exists(img_path):
-                    return self.add_image_to_epub(img_path, match.group(0))
+            img_path = self.resolve_image(img_src, md_dir)
+            if img_path is None:
+                return None
+            try:
+                return self.register_image(img_path)
+            except Exception as e:
+                print(f"添加图片出错: {str(e)}")
+                return None
+    
+    def resolve_image(self, img_src, md_dir=None):
+        """查找图片文件，优先从Markdown文档目录查找，再从指定图片目录查找，找不到时返回None"""
+        index = self.image_index
+        
+        # 如果是网络URL，直接保留
+        if img_src.startswith(('http://', 'https://')):
+            return None
+        
+        # 检查是否为绝对路径
+        if os.path.isabs(img_src):
+            return img_src if index.exists(img_src) else None
+        
+        # 如果是相对路径，先尝试从Markdown文档目录查找
+        if md_dir:
+            md_img_path = os.path.normpath(os.path.join(md_dir, img_src))
+            if index.exists(md_img_path):
+                return md_img_path
+        
+        # 如果在文档目录没找到，再尝试从指定图片目录查找
+        if self.images_dir:
+            img_path = os.path.normpath(os.path.join(self.images_dir, img_src))
+            if index.exists(img_path):
+                return img_path
             
-            # 如果都找不到，返回原始标签
-            return match.group(0)
+            # 尝试直接在images_dir根目录查找图片文件名（不考虑子目录）
+            img_filename = os.path.basename(img_src)
+            img_path = os.path.normpath(os.path.join(self.images_dir, img_filename))
+            if index.exists(img_path):
+                return img_path
         
-        return re.sub(img_pattern, replace_img, html_content)
+        return None
     
-    def add_image_to_epub(self, img_path, img_tag):
-        """将图片添加到EPUB并返回更新后的img标签"""
-        img_name = os.path.basename(img_path)
-        try:
+    def register_image(self, img_path):
+        """登记图片并返回其在EPUB中的路径，同一图片只读取和存储一次
+        
+        文件名由原文件名加上路径（或内容）哈希组成，不同目录下的同名图片不会冲突；
+        按内容去重时文件名只由内容哈希决定。
+        """
+        key = os.path.realpath(img_path)
+        href = self.image_registry.get(key)
+        if href:
+            return href
+        
+        img_file = b''
+        if self.streaming or self.image_pipeline:
+            # 流式输出或需要优化时只记录源文件，之后再读取
+            if not os.access(img_path, os.R_OK):
+                raise OSError(f"无法读取图片: {img_path}")
+            digest = file_hash(img_path) if self._name_images_by_content() else content_hash(key)
+        else:
             with open(img_path, 'rb') as f:
                 img_file = f.read()
-                
+            self.stats.bytes_read += len(img_file)
+            digest = hashlib.sha256(img_file).hexdigest() if self._name_images_by_content() else content_hash(key)
+        
+        stem, ext = os.path.splitext(os.path.basename(img_path))
+        if self.image_pipeline:
+            # 图片格式会被转换时使用新的扩展名
+            ext = self.image_pipeline.target_extension(img_path) or ext
+        source_path = img_path if self.streaming or self.image_pipeline else None
+        if self.dedupe_images_by_content:
+            # 按内容去重时文件名只由内容决定，内容相同的不同文件（包括不同子进程读取的）得到同一个条目
+            img_name = f'image-{digest[:16]}{ext}'
+        else:
+            img_name = f'{stem}-{digest[:8]}{ext}'
+        href = self._add_image_item(img_name, img_file, source_path)
+        self.image_registry[key] = href
+        return href
+    
+    def _name_images_by_content(self):
+        """按内容命名图片：内容去重时，或可重现构建时（路径哈希在不同目录构建时会变化）"""
+        return self.dedupe_images_by_content or self.reproducible
+    
+    def register_image_data(self, img_src, data):
+        """登记内存中的图片内容并返回其在EPUB中的路径，文件名由原文件名加上内容哈希组成"""
+        key = f'data:{img_src}'
+        href = self.image_registry.get(key)
+        if href:
+            return href
+        
+        self.stats.bytes_read += len(data)
+        digest = hashlib.sha256(data).hexdigest()
+        stem, ext = os.path.splitext(os.path.basename(img_src.split('?')[0].split('#')[0]))
+        href = self._add_image_item(f'{stem or "image"}-{digest[:8]}{ext}', data)
+        self.image_registry[key] = href
+        return href
+    
+    def register_remote_image(self, url):
+        """登记网络图片并返回其在EPUB中的路径，文件名由URL中的文件名加上URL哈希组成
+        
+        图片在后台下载，内容在写入前由download_remote_images填入。
+        """
+        href = self.image_registry.get(url)
+        if href:
+            return href
+        
+        from urllib.parse import urlsplit
+        stem, ext = os.path.splitext(os.path.basename(urlsplit(url).path))
+        href = f'images/{stem or "image"}-{content_hash(url)[:8]}{ext}'
+        if href not in self._image_hrefs:
             img_item = epub.EpubItem(
-                uid=img_name.replace('.', '_').replace('-', '_'),
-                file_name=f'images/{img_name}',
-                media_type=self.get_mimetype(img_path),
-                content=img_file
+                uid=os.path.basename(href).replace('.', '_').replace('-', '_'),
+                file_name=href,
+                media_type=self.get_mimetype(href),
+                content=b''
             )
-            self.book.add_item(img_item)
+            img_item.remote_url = url
+            self._add_item(img_item)
+            self._image_hrefs.add(href)
+        self.image_registry[url] = href
+        return href
+    
+    def download_remote_images(self):
+        """等待所有网络图片下载完成并填入内容
+        
+        下载失败的图片从书籍中移除，章节中对它的引用改回原始URL。
+        """
+        pending = self._pending_remote
+        self._pending_remote = []
+        if not pending:
+            return
+        
+        from remote_images import RemoteImageError
+        with self.stats.stage('images'):
+            failed = {}
+            for item in pending:
+                try:
+                    data, content_type = self.remote_fetcher.submit(item.remote_url).result()
+                except RemoteImageError as e:
+                    print(f"下载图片出错: {str(e)}")
+                    failed[item.file_name] = item.remote_url
+                    self.book.items.remove(item)
+                    self._image_hrefs.discard(item.file_name)
+                    self.image_registry.pop(item.remote_url, None)
+                    continue
+                item.content = data
+                if content_type and content_type.startswith('image/'):
+                    item.media_type = content_type
+                if self.stream:
+                    self.stream.write_item(item)
             
-            # 返回更新后的img标签
-            return img_tag.replace(f'src="{img_path}"', f'src="images/{img_name}"').replace(f"src='{img_path}'", f"src='images/{img_name}'")
-        except Exception as e:
-            print(f"添加图片出错: {str(e)}")
-            return img_tag
+            if failed:
+                for chapter in self.book.get_items():
+                    if not isinstance(chapter, epub.EpubHtml) or not isinstance(chapter.content, str):
+                        continue
+                    for href, url in failed.items():
+                        chapter.content = chapter.content.replace(f'"{href}"', f'"{html.escape(url)}"')
+    
+    def _add_image_item(self, img_name, content, source_path=None):
+        """创建图片条目并加入书籍，同名图片只加入一次，返回图片在EPUB中的路径
+        
+        提供source_path时图片内容之后再从源文件读取（流式输出或图片优化）。
+        """
+        href = f'images/{img_name}'
+        if href in self._image_hrefs:
+            return href
+        
+        img_item = epub.EpubItem(
+            uid=img_name.replace('.', '_').replace('-', '_'),
+            file_name=href,
+            media_type=self.get_mimetype(href),
+            content=content
+        )
+        if source_path:
+            img_item.source_path = source_path
+            img_item.optimize = self.image_pipeline is not None
+        self._add_item(img_item)
+        self._image_hrefs.add(href)
+        return href
     
     def get_mimetype(self, file_path):
         """获取文件的MIME类型"""
@@ -137,157 +989,374 @@ class EpubConverter:
         
         return 'application/octet-stream'
     
-    def add_markdown_directory(self, dir_path, custom_toc=None):
-        """添加目录中的所有Markdown文件到EPUB"""
+    def discover_chapters(self, dir_path):
+        """在后台线程中递归发现目录中的章节文件，按阅读顺序逐个返回路径
+        
+        发现与章节渲染同时进行，不必等完整的文件列表建立；全部发现后才知道章节总数，
+        此前的进度回调中总数为None。
+        """
+        import queue
+        import threading
+        
+        found = queue.Queue()
+        done = object()
+        
+        def discover():
+            count = 0
+            try:
+                for md_path in iter_markdown_files(dir_path, self.include, self.exclude):
+                    found.put(md_path)
+                    count += 1
+                self._chapter_total = count
+            except Exception as e:
+                found.put(e)
+            found.put(done)
+        
+        self._chapter_total = None
+        threading.Thread(target=discover, daemon=True).start()
+        while True:
+            item = found.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    
+    def add_markdown_directory(self, dir_path, custom_toc=None, workers=None):
+        """递归添加目录中的所有Markdown文件到EPUB，workers大于1时使用进程池并行渲染章节"""
         if not self.book:
             raise ValueError("请先创建书籍")
         
         chapters = []
-        md_files = sorted([f for f in os.listdir(dir_path) if f.endswith('.md')])
+        self.chapter_root = dir_path
+        md_paths = self.discover_chapters(dir_path)
+        
+        if workers is None:
+            workers = self.workers
+        
+        parallel = self.executor is not None or (workers and workers > 1)
+        if not parallel:
+            for md_path in md_paths:
+                chapter = self.add_markdown_file(md_path, custom_toc)
+                chapters.append(chapter)
+            return chapters
+        
+        # 并行渲染：子进程负责Markdown转换和图片读取，
+        # 主进程按阅读顺序依次加入图片和章节，保证与串行结果一致
+        # 自建进程池时，文件索引在主进程中建立一次，随初始化参数传给各子进程；
+        # 共享进程池的子进程各自为每本书建立索引
+        if self.executor is not None:
+            executor = self.executor
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            self.image_index.add_root(self.images_dir)
+            self.image_index.add_root(dir_path)
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(self.image_index, self.book.uid)
+            )
         
-        for md_file in md_files:
-            md_path = os.path.join(dir_path, md_file)
-            chapter = self.add_markdown_file(md_path, custom_toc)
-            chapters.append(chapter)
+        from collections import deque
+        options = self._worker_options()
+        pending = deque()
+        try:
+            # 章节一经发现就提交渲染，已经完成的章节按顺序立即加入书籍
+            for md_path in md_paths:
+                future = executor.submit(
+                    _render_chapter_job, md_path, options, self.images_dir, self.book.uid, dir_path
+                )
+                pending.append((md_path, future))
+                while pending and pending[0][1].done():
+                    chapters.append(self._add_rendered_chapter(*pending.popleft()))
+            while pending:
+                chapters.append(self._add_rendered_chapter(*pending.popleft()))
+        finally:
+            for _, future in pending:
+                future.cancel()
+            if executor is not self.executor:
+                # 出错或取消时不再等待尚未开始的任务
+                executor.shutdown(cancel_futures=True)
         
         return chapters
     
+    def _add_rendered_chapter(self, md_path, future):
+        """把子进程渲染的结果加入书籍：合并统计，先加入图片再加入章节"""
+        html_content, headings, refs, items, index_stats, stats = future.result()
+        self.stats.merge(stats)
+        hits, misses, probes = index_stats
+        self.image_index.hits += hits
+        self.image_index.misses += misses
+        self.image_index.probes += probes
+        for item in items:
+            # 不同子进程可能各自读取了同一张图片，只保留第一份
+            if item.file_name in self._image_hrefs:
+                continue
+            self._image_hrefs.add(item.file_name)
+            self._add_item(item)
+        return self._add_chapter(md_path, html_content, headings, refs)
+    
     def generate_toc(self, chapters, custom_toc=None):
-        """生成目录，提取Markdown文档中的前三级标题并保持层级关系"""
-        if custom_toc:
+        """生成目录，包含h1到h{toc_depth}的标题并保持层级关系，目录项过多时按toc_max_entries省略深层标题"""
+        toc = self.resolve_custom_toc(custom_toc) if custom_toc else None
+        if toc:
             # 使用自定义目录
-            toc = []
-            for item in custom_toc:
-                toc.append(epub.Link(item['file'], item['title'], item['id']))
             self.book.toc = toc
         else:
-            # 从Markdown内容中提取标题生成目录
-            toc = []
-            
-            for chapter in chapters:
-                # 确保章节标题是字符串
-                chapter_title = str(chapter.title)
-                chapter_filename = chapter.file_name
-                
-                # 为章节创建一个Link对象
-                chapter_link = epub.Link(chapter_filename, chapter_title, chapter_filename.replace('.', '_'))
-                
-                # 检查章节是否有原始内容，如果没有则仅添加章节标题
-                if not hasattr(chapter, 'original_content'):
-                    toc.append(chapter_link)
-                    continue
-                
-                # 解析HTML提取标题
-                soup = BeautifulSoup(chapter.original_content, 'html.parser')
-                
-                # 提取h1, h2, h3标题
-                headings = soup.find_all(['h1', 'h2', 'h3'])
-                
-                if not headings:
-                    # 如果没有找到标题，仅添加章节本身
-                    toc.append(chapter_link)
-                    continue
-                
-                # 记录当前的标题层级结构
-                h1_sections = {}  # 存储h1标题和其对应的Section对象
-                h2_sections = {}  # 存储h2标题和其对应的Section对象
-                
-                chapter_items = []  # 用于存储章节下的所有目录项
-                
-                for heading in headings:
-                    level = int(heading.name[1])  # 1, 2, 或 3
-                    heading_text = str(heading.get_text())
-                    heading_id = heading.get('id', '')
-                    
-                    if not heading_id:
-                        # 如果没有ID，使用文本创建一个
-                        heading_id = 'heading_' + re.sub(r'\W+', '_', heading_text.lower())
-                    
-                    heading_link = f"{chapter_filename}#{heading_id}"
-                    link_id = heading_link.replace('.', '_').replace('#', '_')
-                    
-                    # 创建Link对象
-                    link = epub.Link(heading_link, heading_text, link_id)
-                    
-                    # 基于标题级别构建层级结构
-                    if level == 1:
-                        # 为h1标题创建Section
-                        section = epub.Section(heading_text)
-                        h1_sections[heading_text] = {
-                            'section': section,
-                            'link': link,
-                            'items': []
-                        }
-                        chapter_items.append((section, [link]))
-                        current_h1 = heading_text
-                    elif level == 2 and current_h1 in h1_sections:
-                        # 为h2标题创建Section
-                        section = epub.Section(heading_text)
-                        h2_sections[heading_text] = {
-                            'section': section,
-                            'link': link,
-                            'items': [],
-                            'parent': current_h1
-                        }
-                        h1_sections[current_h1]['items'].append((section, [link]))
-                        current_h2 = heading_text
-                    elif level == 3 and current_h2 in h2_sections:
-                        # h3标题直接添加到对应h2下
-                        h2_sections[current_h2]['items'].append(link)
-                    elif level == 3 and current_h1 in h1_sections:
-                        # h3标题，但没有h2父级，直接附加到h1
-                        h1_sections[current_h1]['items'].append(link)
-                    elif level == 2:
-                        # h2标题，但没有h1父级，直接添加到章节
-                        section = epub.Section(heading_text)
-                        chapter_items.append((section, [link]))
-                        h2_sections[heading_text] = {
-                            'section': section,
-                            'link': link,
-                            'items': []
-                        }
-                        current_h2 = heading_text
-                        current_h1 = None
-                    else:
-                        # 孤立的h3，直接添加到章节
-                        chapter_items.append(link)
-                
-                # 如果有标题项，使用这些作为章节的子项
-                if chapter_items:
-                    # 创建章节Section
-                    chapter_section = epub.Section(chapter_title)
-                    toc.append((chapter_section, chapter_items))
-                else:
-                    # 没有标题，只添加章节链接
-                    toc.append(chapter_link)
-            
-            # 设置目录
-            self.book.toc = toc
+            # 从渲染时提取的标题生成目录（自定义目录全部无效时同样如此），子目录中的章节归入以子目录命名的Section
+            self._toc_level = self.toc_level(chapters)
+            self.book.toc = self.nest_toc(chapters, [self.build_chapter_toc(chapter) for chapter in chapters])
         
-        # 添加默认NCX和NAV
-        self.book.add_item(epub.EpubNcx())
-        self.book.add_item(epub.EpubNav())
+        # 添加默认NCX和NAV，重复生成目录时不再重复添加
+        if self.book.get_item_with_id('ncx') is None:
+            self.book.add_item(epub.EpubNcx())
+        if self.book.get_item_with_id('nav') is None:
+            self.book.add_item(epub.EpubNav())
         
         # 定义CSS样式
-        style = 'body { font-family: Times, Times New Roman, serif; }'
-        nav_css = epub.EpubItem(uid="style_nav", file_name="style/nav.css", media_type="text/css", content=style)
-        self.book.add_item(nav_css)
+        if self.book.get_item_with_id('style_nav') is None:
+            style = 'body { font-family: Times, Times New Roman, serif; }'
+            nav_css = epub.EpubItem(uid="style_nav", file_name="style/nav.css", media_type="text/css", content=style)
+            self.book.add_item(nav_css)
+        
+        # 代码高亮的样式表，章节在加入书籍时已经引用
+        highlighter = self.get_highlighter()
+        if highlighter and self.book.get_item_with_id('style_code') is None:
+            from code_highlight import CSS_FILE
+            code_css = epub.EpubItem(uid="style_code", file_name=CSS_FILE, media_type="text/css",
+                                     content=highlighter.css())
+            self.book.add_item(code_css)
         
         # 定义书脊
-        self.book.spine = ['nav'] + chapters
+        self.book.spine = ['nav'] + self.spine_items(chapters)
+    
+    def resolve_custom_toc(self, custom_toc):
+        """按全书的锚点索引检查自定义目录项，返回有效的目录项列表
+        
+        文件可以写章节文件（intro.xhtml#setup）或Markdown文件（相对于转换的目录，intro.md#setup），
+        锚点位于章节的其他分段时指向该分段；文件或锚点不存在的目录项被跳过并给出提示。
+        """
+        toc = []
+        for item in custom_toc:
+            path, _, fragment = item['file'].partition('#')
+            if path.lower().endswith('.md'):
+                path = segment_file_name(self.chapter_name(os.path.join(self.chapter_root or '', path)), 0)
+            found = self.locate_anchor(path, fragment)
+            if found is None:
+                print(f"自定义目录项无效，已跳过: {item['title']} -> {item['file']}")
+                continue
+            toc.append(epub.Link(f'{found}#{fragment}' if fragment else found, item['title'], item['id']))
+        return toc
+    
+    @staticmethod
+    def nest_toc(chapters, entries):
+        """按章节所在的子目录把章节目录项组织为嵌套的Section，顶层目录中的章节直接列出
+        
+        entries是与chapters一一对应的目录项，子目录的Section链接到其中的第一个章节。
+        """
+        toc = []
+        sections = {(): toc}
+        for chapter, entry in zip(chapters, entries):
+            path = getattr(chapter, 'section', ())
+            for depth in range(1, len(path) + 1):
+                if path[:depth] not in sections:
+                    children = []
+                    sections[path[:depth - 1]].append((epub.Section(path[depth - 1], chapter.file_name), children))
+                    sections[path[:depth]] = children
+            sections[path].append(entry)
+        return toc
+    
+    @staticmethod
+    def spine_items(chapters):
+        """按阅读顺序列出章节和章节的分段"""
+        items = []
+        for chapter in chapters:
+            items.append(chapter)
+            items.extend(getattr(chapter, 'segments', ()))
+        return items
+    
+    def toc_level(self, chapters):
+        """目录包含的最深标题级别：不超过toc_depth，且目录项总数（章节加标题）不超过toc_max_entries"""
+        if not self.toc_max_entries:
+            return self.toc_depth
+        counts = [0] * 7
+        for chapter in chapters:
+            for level, _, _ in getattr(chapter, 'headings', ()):
+                counts[level] += 1
+        total = len(chapters)
+        level = 0
+        for next_level in range(1, self.toc_depth + 1):
+            total += counts[next_level]
+            if total > self.toc_max_entries:
+                break
+            level = next_level
+        if level < self.toc_depth:
+            print(f"目录项过多，只包含h{level}及以上的标题" if level else "目录项过多，只包含章节")
+        return level
+    
+    def build_chapter_toc(self, chapter, max_level=None):
+        """生成单个章节的目录项：有标题时返回(Section, 子项列表)，否则返回章节Link
+        
+        用栈一次遍历标题生成层级结构：栈中是当前标题路径上的各级标题，遇到级别不高于栈顶的标题时出栈，
+        级别跳跃（例如h1下直接是h3）时挂在最近的上级标题下。有子项的标题为Section，其余为Link。
+        max_level默认为生成目录时确定的级别。
+        """
+        chapter_title = str(chapter.title)
+        chapter_filename = chapter.file_name
+        chapter_link = epub.Link(chapter_filename, chapter_title, toc_uid(chapter_filename))
+        
+        if max_level is None:
+            max_level = self.toc_depth if self._toc_level is None else self._toc_level
+        headings = getattr(chapter, 'headings', None)
+        if not headings or max_level < 1:
+            return chapter_link
+        
+        # 分段的章节中，标题可能位于后面的分段文件
+        heading_files = getattr(chapter, 'heading_files', {})
+        used_ids = {chapter_link.uid}
+        root = []
+        stack = []  # [(级别, 子项列表)]
+        for level, heading_text, heading_id in headings:
+            if level > max_level:
+                continue
+            if not heading_id:
+                # 如果没有ID，使用文本创建一个
+                heading_id = 'heading_' + re.sub(r'\W+', '_', heading_text.lower())
+            href = f"{heading_files.get(heading_id, chapter_filename)}#{heading_id}"
+            
+            # 同名标题的链接ID加序号区分，保证NCX中的ID唯一
+            uid = base_uid = toc_uid(href)
+            suffix = 1
+            while uid in used_ids:
+                suffix += 1
+                uid = f'{base_uid}_{suffix}'
+            used_ids.add(uid)
+            
+            while stack and stack[-1][0] >= level:
+                stack.pop()
+            children = []
+            (stack[-1][1] if stack else root).append((epub.Link(href, heading_text, uid), children))
+            stack.append((level, children))
+        
+        if not root:
+            return chapter_link
+        return (epub.Section(chapter_title, chapter_filename), finish_toc(root))
+    
+    def optimize_images(self):
+        """用图片流水线处理所有待优化的图片，流式输出时处理完一张写入一张"""
+        pending = self._pending_images
+        self._pending_images = []
+        if not pending:
+            return
+        
+        cache_dir = self.cache.cache_dir if self.cache else None
+        with self.stats.stage('optimize'):
+            results = self.image_pipeline.run([item.source_path for item in pending], cache_dir, self.executor)
+            for item, (data, fmt, cached) in zip(pending, results):
+                self._report('optimize', len(pending), item.file_name)
+                if cached:
+                    self.stats.image_cache_hits += 1
+                elif cache_dir:
+                    self.stats.image_cache_misses += 1
+                item.content = data
+                if fmt is None:
+                    # 处理失败时保留原图，媒体类型以源文件为准
+                    item.media_type = self.get_mimetype(item.source_path)
+                if self.stream:
+                    self.stream.write_item(item)
     
     def save_epub(self, output_path):
         """保存EPUB文件"""
         if not self.book:
             raise ValueError("请先创建书籍")
         
-        # 确保输出目录存在
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        self.download_remote_images()
+        if self.stream and self._held_items:
+            self._write_held_items(final=True)
+        if self.check_links():
+            shown = ', '.join(f'{source} -> {href}' for source, href in self.dangling_links[:10])
+            more = f" 等共 {len(self.dangling_links)} 个" if len(self.dangling_links) > 10 else ''
+            print(f"无效的站内链接: {shown}{more}")
+        self.optimize_images()
+        self._report('save', 1, output_path)
+        if self.reproducible:
+            self.book.set_identifier(self._content_identifier())
         
-        # 写入EPUB文件
-        epub.write_epub(output_path, self.book, {})
+        with self.stats.stage('save'):
+            if self.stream:
+                # 流式输出时只需写入剩余部分
+                self.stream.close()
+                self.stream = None
+            else:
+                # 确保输出目录存在
+                self._ensure_output_dir(output_path)
+                
+                # 写入EPUB文件，output_path也可以是文件对象
+                from epub_stream import EpubFileWriter
+                writer = EpubFileWriter(self._output_target(output_path), self.book, self._write_options())
+                writer.process()
+                writer.write()
+        self.stats.bytes_written = self._output_size(output_path)
         return output_path
     
+    def _finish_stats(self, start):
+        """构建结束时记录总耗时、图片数和图片查找次数（子进程的查找次数已经合并到image_index）"""
+        self.stats.images = len(self._image_hrefs)
+        self.stats.add_image_index(self.image_index)
+        self.stats.total = time.perf_counter() - start
+    
+    def convert_strings(self, chapters, title, author, output=None, image_resolver=None, cover=None,
+                        custom_toc=None):
+        """在内存中完成转换，不读取Markdown和图片文件，也不写入输出文件
+        
+        chapters为(章节名, Markdown内容)序列，章节名用作章节文件名（章节名.xhtml），重名时抛出ValueError；
+        image_resolver(src)返回图片引用对应的字节内容，找不到时返回None，不提供时图片引用保持原样；
+        cover为封面图片的字节内容。output为None时返回EPUB的字节内容，为文件对象时写入其中并返回该对象。
+        """
+        self.create_book(title, author)
+        if cover:
+            self.book.set_cover('cover.jpg', cover)
+        self.image_resolver = image_resolver
+        self._in_memory = True
+        if hasattr(chapters, '__len__'):
+            self._chapter_total = len(chapters)
+        
+        out = io.BytesIO() if output is None else output
+        if self.streaming:
+            self.open_stream(out)
+        
+        start = time.perf_counter()
+        try:
+            result = []
+            file_names = set()
+            for name, md_content in chapters:
+                # 章节名决定文件名，重名的章节会在EPUB中写入两个同名条目
+                file_name = self.chapter_name(f'{name}.md')
+                if file_name in file_names:
+                    raise ValueError(f"章节名重复: {name}")
+                file_names.add(file_name)
+                chapter_start = time.perf_counter()
+                size = len(md_content.encode('utf-8'))
+                html_content, headings, refs = self.render_markdown(md_content, None, name, size)
+                self.stats.add_chapter(name, size, time.perf_counter() - chapter_start)
+                result.append(self._add_chapter(f'{name}.md', html_content, headings, refs))
+            
+            self._report('toc', 1)
+            with self.stats.stage('toc'):
+                self.generate_toc(result, custom_toc)
+            self.save_epub(out)
+        except Exception:
+            if self.stream:
+                self.stream.abort()
+                self.stream = None
+            raise
+        finally:
+            self.image_resolver = None
+            self._in_memory = False
+            self._finish_stats(start)
+        
+        return out.getvalue() if output is None else output
+    
     def convert_markdown_to_epub(self, input_path, output_path, title, author, cover_path=None, custom_toc=None, images_dir=None):
         """将Markdown转换为EPUB的主函数"""
         # 创建书籍
@@ -297,15 +1366,109 @@ class EpubConverter:
         self.images_dir = images_dir
         
         # 处理输入路径（文件或目录）
-        if os.path.isfile(input_path) and input_path.endswith('.md'):
-            chapters = [self.add_markdown_file(input_path)]
-        elif os.path.isdir(input_path):
-            chapters = self.add_markdown_directory(input_path)
-        else:
+        is_file = os.path.isfile(input_path) and input_path.endswith('.md')
+        if not is_file and not os.path.isdir(input_path):
             raise ValueError("输入路径必须是Markdown文件或包含Markdown文件的目录")
         
-        # 生成目录
-        self.generate_toc(chapters, custom_toc)
+        start = time.perf_counter()
+        if self.profile:
+            import cProfile
+            self.stats.profiler = cProfile.Profile()
+            self.stats.profiler.enable()
+        
+        if self.streaming:
+            self.open_stream(output_path)
+        
+        try:
+            if is_file:
+                self._chapter_total = 1
+                chapters = [self.add_markdown_file(input_path)]
+            else:
+                chapters = self.add_markdown_directory(input_path)
+            
+            # 生成目录
+            self._report('toc', 1)
+            with self.stats.stage('toc'):
+                self.generate_toc(chapters, custom_toc)
+            
+            # 保存EPUB
+            output_file = self.save_epub(output_path)
+        except Exception:
+            # 出错时删除未完成的流式输出文件
+            if self.stream:
+                self.stream.abort()
+                self.stream = None
+            raise
+        finally:
+            if self.stats.profiler is not None:
+                self.stats.profiler.disable()
+            if self.remote_fetcher is not None:
+                self.remote_fetcher.close()
+            self._finish_stats(start)
+        
+        # 控制缓存大小
+        if self.cache and self.prune_cache_after_build:
+            self.cache.prune()
+        
+        if self.image_index.hits or self.image_index.misses:
+            print(self.image_index.summary())
+        if self.remote_fetcher is not None:
+            print(self.remote_fetcher.summary())
+        return output_file
+    
+    async def convert_async(self, input_path, output_path, title, author, cover_path=None, custom_toc=None,
+                            images_dir=None, executor=None):
+        """异步转换，返回(输出文件, 构建统计)
+        
+        每次调用都在独立的转换器（clone）上构建，本实例的状态不会被修改，
+        可以在同一个事件循环中同时进行多个构建。文件读写和整个构建在executor
+        （默认为事件循环的线程池）中运行，不阻塞事件循环；Markdown渲染等CPU密集的阶段
+        使用本实例的进程池（executor参数或workers）并行处理。
+        等待的任务被取消时，构建会在下一个进度点停止。
+        """
+        import asyncio
         
-        # 保存EPUB
-        return self.save_epub(output_path)
+        converter = self.clone()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            executor,
+            converter.convert_markdown_to_epub,
+            input_path, output_path, title, author, cover_path, custom_toc, images_dir
+        )
+        try:
+            output_file = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # 线程无法被强行停止，通知转换器取消并等待它结束，避免留下未完成的输出文件
+            converter.cancel()
+            try:
+                await future
+            except ConversionCancelled:
+                pass
+            raise
+        return output_file, converter.stats
+    
+    async def stream_async(self, input_path, title, author, cover_path=None, custom_toc=None, images_dir=None,
+                           executor=None, chunk_size=256 * 1024):
+        """异步构建EPUB并按块返回文件内容，用于直接写入HTTP响应
+        
+        EPUB先写入临时目录，再分块读取，读取同样不阻塞事件循环；
+        迭代结束或提前关闭时删除临时文件。
+        """
+        import asyncio
+        import shutil
+        import tempfile
+        
+        loop = asyncio.get_running_loop()
+        temp_dir = await loop.run_in_executor(executor, tempfile.mkdtemp, None, 'md2epub-')
+        try:
+            output_path = os.path.join(temp_dir, 'book.epub')
+            await self.convert_async(input_path, output_path, title, author, cover_path, custom_toc,
+                                     images_dir, executor)
+            with open(output_path, 'rb') as f:
+                while True:
+                    chunk = await loop.run_in_executor(executor, f.read, chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            await loop.run_in_executor(executor, shutil.rmtree, temp_dir, True)
@@ -0,0 +1,61 @@
+import os
+import re
+from fnmatch import fnmatchcase
+
+# 默认收录的章节文件
+DEFAULT_INCLUDE = ('*.md',)
+
+_DIGITS = re.compile(r'(\d+)')
+
+
+def natural_key(name):
+    """自然排序的键：名称中的数字按数值比较，10-x.md排在9-x.md之后，字母不区分大小写"""
+    parts = _DIGITS.split(name.casefold())
+    # split的结果中奇数位置总是数字，比较时数字和字符串不会相遇
+    parts[1::2] = [int(part) for part in parts[1::2]]
+    return parts, name
+
+
+def path_key(rel_path):
+    """相对路径的排序键，与iter_markdown_files的遍历顺序一致"""
+    return [natural_key(part) for part in re.split(r'[\\/]', rel_path)]
+
+
+def matches(rel_path, patterns):
+    """判断相对路径是否匹配任一glob：包含/的模式匹配整个相对路径，否则只匹配文件名"""
+    rel_path = rel_path.replace(os.sep, '/')
+    name = rel_path.rsplit('/', 1)[-1]
+    return any(fnmatchcase(rel_path if '/' in pattern else name, pattern) for pattern in patterns)
+
+
+def _sorted_entries(path):
+    with os.scandir(path) as it:
+        return iter(sorted(it, key=lambda entry: natural_key(entry.name)))
+
+
+def iter_markdown_files(root, include=DEFAULT_INCLUDE, exclude=()):
+    """递归发现目录中的章节文件，按自然排序深度优先逐个返回路径
+
+    每个目录只用os.scandir读取一次，文件和子目录按名称一起排序，子目录中的章节
+    排在该子目录名称所在的位置。隐藏目录（.git、.md2epub-cache等）和匹配exclude
+    的目录整体跳过，无法读取的子目录被忽略。
+    """
+    # 栈中保存每一层目录尚未处理的条目
+    stack = [(_sorted_entries(root), '')]
+    while stack:
+        entries, rel_dir = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            continue
+
+        rel_path = rel_dir + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name.startswith('.') or matches(rel_path, exclude):
+                continue
+            try:
+                stack.append((_sorted_entries(entry.path), rel_path + '/'))
+            except OSError:
+                continue
+        elif entry.is_file() and matches(rel_path, include) and not matches(rel_path, exclude):
+            yield entry.path
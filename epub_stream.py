@@ -0,0 +1,196 @@
+import os
+import time
+import hashlib
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from ebooklib import epub
+
+
+# 已经压缩过的媒体格式，再用deflate压缩几乎不会变小，直接存储
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.m4a', '.ogg', '.woff', '.woff2')
+
+
+class EpubZipFile(zipfile.ZipFile):
+    """按条目类型选择压缩方式的ZipFile
+
+    扩展名在store_extensions中的条目直接存储，其余条目按compresslevel进行deflate压缩，
+    compresslevel为0时全部直接存储；
+    date_time不为None时所有条目使用这个固定的时间戳（可重现构建）。
+    """
+    def __init__(self, file, compresslevel=6, date_time=None, store_extensions=STORED_EXTENSIONS):
+        super().__init__(file, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        self.date_time = date_time
+        self.store_extensions = tuple(store_extensions)
+
+    def entry_info(self, arcname):
+        """按压缩策略创建条目信息"""
+        zinfo = zipfile.ZipInfo(arcname, date_time=self.date_time or time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o600 << 16
+        if self.compresslevel == 0 or arcname.lower().endswith(self.store_extensions):
+            # 级别0表示只存储：deflate的0级仍然输出deflate格式，直接存储更快，阅读器兼容性也更好
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            # ZipFile.open按条目信息中的级别压缩，没有公开的参数可以指定
+            zinfo._compresslevel = self.compresslevel
+        return zinfo
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None, compresslevel=None):
+        if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+            zinfo_or_arcname = self.entry_info(zinfo_or_arcname)
+        super().writestr(zinfo_or_arcname, data, compress_type, compresslevel)
+
+
+class CountingWriter:
+    """不能定位的输出流（例如只写的网络响应）的包装，统计写入的字节数
+
+    没有tell和seek，ZipFile会按不可定位的流写入（条目后附数据描述符）。
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.raw.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        flush = getattr(self.raw, 'flush', None)
+        if flush:
+            flush()
+
+
+def open_zip(file_name, options):
+    """按写入选项打开zip文件：compresslevel为文本的压缩级别，store_extensions为直接存储的扩展名，
+    zip_date_time不为None时所有条目使用该时间戳"""
+    return EpubZipFile(
+        file_name,
+        compresslevel=options['compresslevel'],
+        date_time=options.get('zip_date_time'),
+        store_extensions=options.get('store_extensions', STORED_EXTENSIONS)
+    )
+
+
+def archive_name(book, item):
+    if item.manifest:
+        return f'{book.FOLDER_NAME}/{item.file_name}'
+    return item.file_name
+
+
+class EpubFileWriter(epub.EpubWriter):
+    """一次写入整本书的EPUB写入器，与epub.write_epub相同，但使用open_zip的压缩策略
+
+    compression_workers选项大于1时，用线程池并行生成各条目的内容（章节需要lxml解析和序列化），
+    与主线程的压缩写入重叠进行。zipfile没有写入预先压缩数据的公开接口，deflate本身仍在主线程中进行。
+    """
+    def write(self):
+        self.out = open_zip(self.file_name, self.options)
+        self.out.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+
+        self._write_container()
+        self._write_opf()
+        self._write_items()
+
+        self.out.close()
+
+    def _item_content(self, item):
+        if isinstance(item, epub.EpubNcx):
+            return self._get_ncx()
+        if isinstance(item, epub.EpubNav):
+            return self._get_nav(item)
+        return item.get_content()
+
+    def _write_items(self):
+        workers = self.options.get('compression_workers') or 1
+        items = list(self.book.get_items())
+        if workers <= 1:
+            for item in items:
+                self.out.writestr(archive_name(self.book, item), self._item_content(item))
+            return
+
+        # 按顺序写入，同时最多准备workers * 2个条目，避免所有条目的内容同时留在内存中
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for item in items:
+                pending.append((item, pool.submit(self._item_content, item)))
+                if len(pending) >= workers * 2:
+                    done, future = pending.popleft()
+                    self.out.writestr(archive_name(self.book, done), future.result())
+            while pending:
+                done, future = pending.popleft()
+                self.out.writestr(archive_name(self.book, done), future.result())
+
+
+class StreamingEpubWriter(epub.EpubWriter):
+    """边生成边写入的EPUB写入器
+
+    章节和图片在加入书籍时立即写入zip文件并释放内容，图片文件按块复制，
+    目录、导航和OPF等依赖全书信息的文件在close时写入，因此内存占用与书籍大小无关。
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, name, book, options=None):
+        # 页码列表需要重新解析全部章节内容，而章节写入后内容已释放，因此流式输出时不生成
+        options = dict(options or {})
+        options.setdefault('epub3_pages', False)
+        super().__init__(name, book, options)
+        self._written = set()
+        # 按写入顺序计算已写入条目的内容哈希，章节内容写入后即释放，无法事后再计算
+        self.digest = hashlib.sha256()
+
+        # mimetype必须是第一个且不压缩的条目
+        self.out = open_zip(self.file_name, self.options)
+        self.out.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self._write_container()
+
+    def _archive_name(self, item):
+        return archive_name(self.book, item)
+
+    def write_item(self, item):
+        """立即写入条目内容，写入后清空条目内容以释放内存"""
+        content = item.get_content()
+        self.out.writestr(self._archive_name(item), content)
+        self.digest.update(item.file_name.encode('utf-8'))
+        self.digest.update(content if isinstance(content, bytes) else content.encode('utf-8'))
+        self._written.add(item.file_name)
+        item.content = b''
+
+    def write_file(self, item, file_path):
+        """将文件按块复制到zip中，不把整个文件读入内存"""
+        zinfo = self.out.entry_info(self._archive_name(item))
+        zinfo.file_size = os.path.getsize(file_path)
+
+        self.digest.update(item.file_name.encode('utf-8'))
+        with open(file_path, 'rb') as src, self.out.open(zinfo, 'w') as dst:
+            for chunk in iter(lambda: src.read(self.CHUNK_SIZE), b''):
+                self.digest.update(chunk)
+                dst.write(chunk)
+        self._written.add(item.file_name)
+
+    def is_written(self, item):
+        return item.file_name in self._written
+
+    def close(self):
+        """写入OPF、目录、导航以及尚未写入的条目，完成EPUB文件"""
+        self._write_opf()
+
+        for item in self.book.get_items():
+            if item.file_name in self._written:
+                continue
+            if isinstance(item, epub.EpubNcx):
+                self.out.writestr(self._archive_name(item), self._get_ncx())
+            elif isinstance(item, epub.EpubNav):
+                self.out.writestr(self._archive_name(item), self._get_nav(item))
+            else:
+                self.out.writestr(self._archive_name(item), item.get_content())
+
+        self.out.close()
+
+    def abort(self):
+        """放弃写入并删除未完成的文件"""
+        self.out.close()
+        # 写入文件对象时由调用方处理
+        if isinstance(self.file_name, (str, os.PathLike)) and os.path.exists(self.file_name):
+            os.remove(self.file_name)
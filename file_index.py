@@ -0,0 +1,93 @@
+import os
+
+
+class FileIndex:
+    """文件存在性索引
+
+    用os.scandir一次性扫描图片目录和章节目录，之后的图片路径查找只在内存中进行，
+    避免对每个图片引用反复调用os.path.exists（在网络盘上每次都很慢）。
+    不在已扫描目录下的路径退回到文件系统查询，并缓存查询结果；扫描时跳过的隐藏目录和
+    符号链接目录中的文件不在索引中，索引中找不到的路径同样先查询文件系统再判定为不存在。
+    """
+    def __init__(self):
+        self.roots = []
+        self.files = set()
+        self._probe_cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+
+    @staticmethod
+    def _key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def covers(self, path):
+        """判断路径是否位于已扫描的目录下"""
+        key = self._key(path)
+        for root in self.roots:
+            if key == root or key.startswith(root + os.sep):
+                return True
+        return False
+
+    def add_root(self, root):
+        """递归扫描目录并加入索引，已扫描过的目录会被跳过，返回新增的文件数"""
+        if not root or not os.path.isdir(root) or self.covers(root):
+            return 0
+
+        root_key = self._key(root)
+        # 新目录包含了之前扫描过的子目录时，移除这些子目录，避免重复判断
+        self.roots = [r for r in self.roots if not r.startswith(root_key + os.sep)]
+        self.roots.append(root_key)
+
+        count = 0
+        stack = [root_key]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        # 跳过隐藏目录，例如.git和构建缓存
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.name.startswith('.'):
+                                stack.append(entry.path)
+                        elif entry.is_file():
+                            self.files.add(os.path.normcase(entry.path))
+                            count += 1
+            except OSError:
+                continue
+        return count
+
+    def exists(self, path):
+        """判断文件是否存在，优先使用索引"""
+        key = self._key(path)
+        found = self.covers(key) and key in self.files
+        if not found:
+            found = self._probe_cache.get(key)
+            if found is None:
+                self.probes += 1
+                found = os.path.isfile(key)
+                self._probe_cache[key] = found
+
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def refresh(self, path):
+        """文件新增或删除后更新索引中的记录"""
+        key = self._key(path)
+        self._probe_cache.pop(key, None)
+        if self.covers(key):
+            if os.path.isfile(key):
+                self.files.add(key)
+            else:
+                self.files.discard(key)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+
+    def summary(self):
+        return f"图片索引: 已索引 {len(self.files)} 个文件，命中 {self.hits} 次，未命中 {self.misses} 次，文件系统查询 {self.probes} 次"
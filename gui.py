@@ -1,4 +1,7 @@
 import os
+import time
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from tkinter.scrolledtext import ScrolledText
@@ -7,11 +10,27 @@ class MarkdownToEpubApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Markdown转EPUB工具")
-        self.root.geometry("700x700")
+        self.root.geometry("700x760")
         self.root.resizable(True, True)
         
+        self.converter = None
         self.create_widgets()
         self.layout_widgets()
+        
+        # 窗口可以交互后再在后台导入转换器，不占用启动时间
+        self.root.after(500, self.preload_converter)
+    
+    def preload_converter(self):
+        """在后台线程中导入转换器及markdown、ebooklib，首次转换时不必等待导入"""
+        def preload():
+            try:
+                import converter  # noqa: F401
+                import md_extensions  # noqa: F401
+            except ImportError:
+                # 缺少依赖时由转换时的导入报告错误
+                pass
+        
+        threading.Thread(target=preload, daemon=True).start()
     
     def create_widgets(self):
         # 输入文件/目录选择
@@ -63,8 +82,15 @@ class MarkdownToEpubApp:
         self.toc_editor_label = ttk.Label(self.toc_frame, text="每行一个目录项，格式: 标题|文件名")
         self.toc_editor = ScrolledText(self.toc_frame, height=10, width=50, state=tk.DISABLED)
         
-        # 转换按钮
-        self.convert_btn = ttk.Button(self.root, text="转换为EPUB", command=self.convert)
+        # 转换和取消按钮
+        self.action_frame = ttk.Frame(self.root)
+        self.convert_btn = ttk.Button(self.action_frame, text="转换为EPUB", command=self.convert)
+        self.cancel_btn = ttk.Button(self.action_frame, text="取消", command=self.cancel_convert, state=tk.DISABLED)
+        
+        # 进度条和进度说明
+        self.progress_bar = ttk.Progressbar(self.root, mode='determinate', maximum=100)
+        self.progress_var = tk.StringVar(value="")
+        self.progress_label = ttk.Label(self.root, textvariable=self.progress_var, anchor=tk.W)
         
         # 状态栏
         self.status_var = tk.StringVar(value="就绪")
@@ -109,7 +135,13 @@ class MarkdownToEpubApp:
         self.toc_editor.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
         
         # 转换按钮布局
-        self.convert_btn.pack(pady=10)
+        self.action_frame.pack(pady=10)
+        self.convert_btn.pack(side=tk.LEFT, padx=5)
+        self.cancel_btn.pack(side=tk.LEFT, padx=5)
+        
+        # 进度布局
+        self.progress_bar.pack(fill=tk.X, padx=10)
+        self.progress_label.pack(fill=tk.X, padx=10, pady=2)
         
         # 状态栏布局
         self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
@@ -215,15 +247,116 @@ class MarkdownToEpubApp:
         
         # 更新状态
         self.status_var.set("正在转换...")
-        self.root.update()
+        self.convert_btn.config(state=tk.DISABLED)
+        self.cancel_btn.config(state=tk.NORMAL)
+        self.progress_bar['value'] = 0
+        self.progress_var.set("")
         
+        # 在后台线程中转换，进度通过队列传回主线程，避免界面失去响应
         from converter import EpubConverter
-        converter = EpubConverter()
-        output_file = converter.convert_markdown_to_epub(
-            input_path, output_path, title, author, cover_path, custom_toc, images_dir
+        self.progress_queue = queue.Queue()
+        self.converter = EpubConverter(progress=self.on_progress)
+        self.convert_start = time.monotonic()
+        
+        thread = threading.Thread(
+            target=self.run_conversion,
+            args=(input_path, output_path, title, author, cover_path, custom_toc, images_dir),
+            daemon=True
         )
-        messagebox.showinfo("成功", f"转换完成！\n文件已保存到: {output_file}")
-        self.status_var.set("转换完成")
+        thread.start()
+        self.root.after(100, self.poll_progress)
+    
+    def run_conversion(self, *args):
+        """后台线程：执行转换，把结果放入进度队列"""
+        from converter import ConversionCancelled
+        try:
+            output_file = self.converter.convert_markdown_to_epub(*args)
+            self.progress_queue.put(('done', (output_file, self.converter.stats.summary())))
+        except ConversionCancelled:
+            self.progress_queue.put(('cancelled', None))
+        except Exception as e:
+            self.progress_queue.put(('error', str(e)))
+    
+    def on_progress(self, stage, current, total, message):
+        """转换器的进度回调，在后台线程中调用，只向队列写入"""
+        self.progress_queue.put(('progress', (stage, current, total, message)))
+    
+    def cancel_convert(self):
+        if self.converter:
+            self.converter.cancel()
+            self.cancel_btn.config(state=tk.DISABLED)
+            self.status_var.set("正在取消...")
+    
+    def poll_progress(self):
+        """定时读取进度队列并更新界面"""
+        latest = None
+        result = None
+        try:
+            while True:
+                kind, data = self.progress_queue.get_nowait()
+                if kind == 'progress':
+                    latest = data
+                else:
+                    result = (kind, data)
+        except queue.Empty:
+            pass
+        
+        if latest:
+            self.show_progress(*latest)
+        
+        if result is None:
+            self.root.after(100, self.poll_progress)
+            return
+        
+        self.convert_btn.config(state=tk.NORMAL)
+        self.cancel_btn.config(state=tk.DISABLED)
+        self.converter = None
+        kind, data = result
+        if kind == 'done':
+            output_file, summary = data
+            self.progress_bar['value'] = 100
+            # 状态栏显示各阶段耗时和最慢的章节，便于找出拖慢构建的文件
+            self.status_var.set(f"转换完成：{summary}")
+            messagebox.showinfo("成功", f"转换完成！\n文件已保存到: {output_file}")
+        elif kind == 'cancelled':
+            self.status_var.set("转换已取消")
+        else:
+            self.status_var.set("转换失败")
+            messagebox.showerror("错误", f"转换失败: {data}")
+    
+    def show_progress(self, stage, current, total, message):
+        """根据当前阶段估算整体进度：章节占80%，图片优化占15%，目录和保存占5%"""
+        if stage == 'chapter' and total:
+            fraction = 0.8 * current / total
+            text = f"章节 {current}/{total}"
+        elif stage == 'chapter':
+            # 目录中的章节仍在发现，总数未知
+            fraction = self.progress_bar['value'] / 100
+            text = f"章节 {current}"
+        elif stage == 'image':
+            fraction = self.progress_bar['value'] / 100
+            text = f"图片 {current}"
+        elif stage == 'optimize' and total:
+            fraction = 0.8 + 0.15 * current / total
+            text = f"优化图片 {current}/{total}"
+        elif stage == 'toc':
+            fraction = 0.95
+            text = "生成目录"
+        else:
+            fraction = 0.97
+            text = "写入文件"
+        
+        self.progress_bar['value'] = fraction * 100
+        elapsed = time.monotonic() - self.convert_start
+        text += f"  已用 {self.format_seconds(elapsed)}"
+        if 0 < fraction < 1:
+            text += f"  预计剩余 {self.format_seconds(elapsed * (1 - fraction) / fraction)}"
+        self.progress_var.set(text)
+    
+    @staticmethod
+    def format_seconds(seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        return f"{minutes:02d}:{seconds:02d}"
     
     def use_default_images_dir(self):
         """设置默认图片目录（Markdown文档所在目录下的images子目录）"""
@@ -0,0 +1,175 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from build_cache import BuildCache, content_hash
+
+# 可以重新编码的图片格式，GIF（可能是动画）和SVG保持原样
+OPTIMIZABLE_FORMATS = ('PNG', 'JPEG', 'WEBP')
+
+FORMAT_EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+}
+
+
+# 照片判断：缩小到PHOTO_SAMPLE_SIZE见方后颜色数超过PHOTO_MIN_COLORS的PNG视为照片
+PHOTO_SAMPLE_SIZE = 64
+PHOTO_MIN_COLORS = 1024
+
+
+def _has_alpha(im):
+    return im.mode in ('RGBA', 'LA', 'PA') or (im.mode == 'P' and 'transparency' in im.info)
+
+
+def _is_photo(im):
+    """粗略判断是否为照片：缩小后颜色仍然很多
+
+    截图、图表等颜色较少，转换为有损格式后文字和线条边缘会出现明显的压缩痕迹，文件也未必更小。
+    用最近邻缩小，不引入原图中没有的颜色。
+    """
+    from PIL import Image
+
+    small = im.resize((min(im.width, PHOTO_SAMPLE_SIZE), min(im.height, PHOTO_SAMPLE_SIZE)), Image.NEAREST)
+    if small.mode != 'RGB':
+        small = small.convert('RGB')
+    return small.getcolors(PHOTO_MIN_COLORS) is None
+
+
+def _target_format(source_format, im, convert_to):
+    """确定输出格式：只把看起来是照片的不透明PNG转换为convert_to指定的格式"""
+    if convert_to and source_format == 'PNG' and not _has_alpha(im) and _is_photo(im):
+        return convert_to.upper()
+    return source_format
+
+
+def optimize_image(img_path, options, cache_dir=None):
+    """按配置优化单张图片，返回(图片数据, 输出格式, 是否命中缓存)
+
+    结果按原图内容哈希和配置缓存，未变化的图片不会重复编码。
+    不支持的格式或处理失败时返回原图数据，输出格式为None表示格式未知。
+    """
+    with open(img_path, 'rb') as f:
+        data = f.read()
+
+    cache = BuildCache(cache_dir, None) if cache_dir else None
+    # 照片判断的参数影响输出格式，同样是缓存键的一部分
+    cache_key = content_hash(data, repr(sorted(options.items())), f'photo:{PHOTO_SAMPLE_SIZE}:{PHOTO_MIN_COLORS}')
+    if cache:
+        cached = cache.get('images', cache_key)
+        if cached is not None:
+            fmt, _, cached_data = cached.partition(b'\n')
+            return cached_data, fmt.decode('ascii') or None, True
+
+    try:
+        from PIL import Image
+
+        im = Image.open(io.BytesIO(data))
+        source_format = im.format
+        if source_format not in OPTIMIZABLE_FORMATS:
+            return data, source_format, False
+
+        target_format = _target_format(source_format, im, options.get('convert_to'))
+        changed = target_format != source_format
+
+        max_dimension = options.get('max_dimension')
+        if max_dimension and max(im.size) > max_dimension:
+            im.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            changed = True
+
+        save_args = {}
+        icc_profile = im.info.get('icc_profile')
+        if icc_profile:
+            save_args['icc_profile'] = icc_profile
+        if not options.get('strip_metadata', True) and im.info.get('exif'):
+            save_args['exif'] = im.info['exif']
+
+        if target_format == 'JPEG':
+            if im.mode not in ('RGB', 'L'):
+                im = im.convert('RGB')
+            buf = io.BytesIO()
+            im.save(buf, 'JPEG', quality=options.get('quality', 85), optimize=True, **save_args)
+        elif target_format == 'WEBP':
+            buf = io.BytesIO()
+            im.save(buf, 'WEBP', quality=options.get('quality', 85), **save_args)
+        else:
+            if options.get('quantize') and im.mode != 'P':
+                if im.mode not in ('RGB', 'RGBA'):
+                    im = im.convert('RGBA' if _has_alpha(im) else 'RGB')
+                method = Image.FASTOCTREE if im.mode == 'RGBA' else Image.MEDIANCUT
+                im = im.quantize(256, method=method)
+                changed = True
+            buf = io.BytesIO()
+            im.save(buf, 'PNG', optimize=True, **save_args)
+
+        result = buf.getvalue()
+        # 格式和尺寸都没变时，重新编码反而更大就保留原图
+        if not changed and len(result) >= len(data):
+            result = data
+    except Exception as e:
+        print(f"优化图片出错: {img_path}: {str(e)}")
+        return data, None, False
+
+    if cache:
+        cache.put('images', cache_key, target_format.encode('ascii') + b'\n' + result)
+    return result, target_format, False
+
+
+class ImagePipeline:
+    """图片优化流水线：缩小尺寸、PNG转JPEG/WebP、调色板量化、去除元数据
+
+    图片在生成EPUB前统一交给进程池处理，结果存入构建缓存的images命名空间。
+    """
+    def __init__(self, max_dimension=None, convert_to=None, quantize=False, strip_metadata=True,
+                 quality=85, workers=None):
+        self.max_dimension = max_dimension
+        # 不透明的照片PNG的转换目标格式：'jpeg'、'webp'或None（不转换），截图、图表等颜色较少的PNG不转换
+        self.convert_to = convert_to
+        self.quantize = quantize
+        self.strip_metadata = strip_metadata
+        self.quality = quality
+        # 进程池大小，None表示使用CPU核数
+        self.workers = workers
+
+    def options(self):
+        return {
+            'max_dimension': self.max_dimension,
+            'convert_to': self.convert_to,
+            'quantize': self.quantize,
+            'strip_metadata': self.strip_metadata,
+            'quality': self.quality,
+        }
+
+    def target_extension(self, img_path):
+        """判断输出格式（PNG需要解码才能判断是否为照片），返回新的扩展名，格式不变时返回None"""
+        if not self.convert_to:
+            return None
+        try:
+            from PIL import Image
+
+            with Image.open(img_path) as im:
+                source_format = im.format
+                target_format = _target_format(source_format, im, self.convert_to)
+        except Exception:
+            return None
+        if target_format == source_format:
+            return None
+        return FORMAT_EXTENSIONS.get(target_format)
+
+    def run(self, img_paths, cache_dir=None, executor=None):
+        """处理一组图片，按输入顺序逐个返回(图片数据, 输出格式, 是否命中缓存)，可以传入共享的进程池"""
+        options = self.options()
+        count = len(img_paths)
+        if executor is not None and count > 1:
+            yield from executor.map(optimize_image, img_paths, [options] * count, [cache_dir] * count)
+            return
+
+        workers = self.workers or os.cpu_count() or 1
+        if workers <= 1 or count <= 1:
+            for img_path in img_paths:
+                yield optimize_image(img_path, options, cache_dir)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(optimize_image, img_paths, [options] * count, [cache_dir] * count)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Markdown转EPUB命令行工具，不依赖Tkinter
+
+用法:
+    python -m md2epub build books.toml [--workers N] [--cache-dir DIR] [--no-cache]
+    python -m md2epub watch docs/guide -o dist/guide.epub [--title 标题] [--author 作者]
+
+清单文件（TOML或JSON）描述要构建的多本书，所有书在同一个进程中构建，
+共享进程池和构建缓存:
+
+    [defaults]
+    author = "文档组"
+    images_dir = "images"
+
+    [[books]]
+    input = "docs/guide"
+    output = "dist/guide.epub"
+    title = "用户指南"
+
+    [[books]]
+    input = "docs/api.md"
+    output = "dist/api.epub"
+    title = "API参考"
+    cover = "covers/api.jpg"
+    toc = [{ title = "概述", file = "api.xhtml" }]
+
+清单中的相对路径以清单文件所在目录为基准。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+from build_cache import BuildCache, DEFAULT_CACHE_DIR, DEFAULT_SIZE_LIMIT
+
+# 书籍配置中表示路径的字段
+PATH_FIELDS = ('input', 'output', 'cover', 'images_dir')
+
+
+def load_manifest(manifest_path):
+    """读取清单文件，返回书籍配置列表，默认配置已合并，相对路径已转换"""
+    with open(manifest_path, 'rb') as f:
+        raw = f.read()
+
+    if manifest_path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError("读取TOML清单需要Python 3.11及以上版本，请改用JSON清单")
+        manifest = tomllib.loads(raw.decode('utf-8'))
+    else:
+        manifest = json.loads(raw.decode('utf-8'))
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    defaults = manifest.get('defaults', {})
+    books = []
+    for index, entry in enumerate(manifest.get('books', [])):
+        book = dict(defaults)
+        book.update(entry)
+        for field in ('input', 'output', 'title', 'author'):
+            if not book.get(field):
+                raise ValueError(f"第{index + 1}本书缺少字段: {field}")
+        for field in PATH_FIELDS:
+            if book.get(field):
+                book[field] = os.path.join(base_dir, book[field])
+        books.append(book)
+
+    if not books:
+        raise ValueError("清单中没有书籍")
+    return books
+
+
+def parse_toc(toc):
+    """把清单中的目录项转换为generate_toc使用的格式"""
+    if not toc:
+        return None
+    return [
+        {
+            'title': item['title'],
+            'file': item['file'],
+            'id': item.get('id', item['file'].replace('.', '_'))
+        }
+        for item in toc
+    ]
+
+
+def print_progress(stage, current, total, message):
+    """命令行进度输出，写到标准错误，不影响标准输出中的构建结果"""
+    if stage == 'image':
+        return
+    count = f"{current}/{total}" if total else str(current)
+    end = '\n' if stage == 'save' else ''
+    sys.stderr.write(f"\r  {stage} {count} {message}"[:100].ljust(100) + end)
+    sys.stderr.flush()
+
+
+def create_converter(args, executor):
+    """按命令行参数创建转换器，多本书共用同一个转换器、进程池和缓存"""
+    from converter import EpubConverter
+
+    image_pipeline = None
+    if args.max_image_size or args.image_format:
+        from image_pipeline import ImagePipeline
+        image_pipeline = ImagePipeline(max_dimension=args.max_image_size, convert_to=args.image_format)
+
+    converter = EpubConverter(
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_size_limit=args.cache_size * 1024 * 1024,
+        streaming=args.streaming,
+        image_pipeline=image_pipeline,
+        executor=executor,
+        progress=print_progress if args.progress else None,
+        profile=bool(args.profile),
+        split_level=args.split_level,
+        split_size=args.split_size * 1024,
+        reproducible=args.reproducible,
+        compress_level=args.compress_level,
+        store_media=not args.compress_media,
+        compression_workers=args.compression_workers,
+        include=args.include,
+        exclude=args.exclude,
+        remote_images=args.remote_images,
+        remote_workers=args.remote_workers,
+        highlight=args.highlight is not None,
+        highlight_style=args.highlight or 'default',
+        toc_depth=args.toc_depth,
+        toc_max_entries=args.toc_max_entries
+    )
+    # 缓存只在全部构建完成后清理一次
+    converter.prune_cache_after_build = False
+    return converter
+
+
+def build_books(books, converter, stats=False, profile_dir=None):
+    """依次构建每本书，返回每本书的构建结果
+
+    stats为True时结果中包含每本书的阶段耗时和章节统计，
+    提供profile_dir时把每本书的cProfile结果写入该目录。
+    """
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    results = []
+    for book in books:
+        start = time.perf_counter()
+        try:
+            converter.convert_markdown_to_epub(
+                book['input'],
+                book['output'],
+                book['title'],
+                book['author'],
+                book.get('cover'),
+                parse_toc(book.get('toc')),
+                book.get('images_dir')
+            )
+            status, error = 0, None
+        except Exception as e:
+            status, error = 1, str(e)
+        elapsed = time.perf_counter() - start
+
+        result = {
+            'title': book['title'],
+            'output': book['output'],
+            'status': status,
+            'seconds': round(elapsed, 3),
+            'error': error,
+        }
+        if status == 0 and converter.dangling_links:
+            result['dangling_links'] = [f'{source} -> {href}' for source, href in converter.dangling_links]
+        mark = '成功' if status == 0 else f'失败: {error}'
+        print(f"[{elapsed:7.2f}s] {book['title']} -> {book['output']} {mark}")
+        if stats and status == 0:
+            result['stats'] = converter.stats.to_dict()
+            print(f"           {converter.stats.summary()}")
+        if profile_dir and converter.stats.profiler is not None:
+            name = os.path.splitext(os.path.basename(book['output']))[0]
+            converter.stats.dump_profile(os.path.join(profile_dir, f'{name}.prof'))
+        results.append(result)
+    return results
+
+
+def cmd_build(args):
+    try:
+        books = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        print(f"读取清单出错: {str(e)}")
+        return 2
+
+    if args.clear_cache:
+        BuildCache(args.cache_dir).clear()
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    start = time.perf_counter()
+    workers = args.workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    converter = None
+    try:
+        converter = create_converter(args, executor)
+        results = build_books(books, converter, args.stats, args.profile)
+    except (ImportError, OSError) as e:
+        # 例如缺少可选依赖，或无法创建缓存目录
+        print(f"创建转换器出错: {str(e)}")
+        return 2
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if converter is not None and converter.cache:
+        converter.cache.prune()
+
+    failed = sum(1 for result in results if result['status'] != 0)
+    elapsed = time.perf_counter() - start
+    print(f"共 {len(results)} 本，成功 {len(results) - failed} 本，失败 {failed} 本，总耗时 {elapsed:.2f}s")
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({'seconds': round(elapsed, 3), 'books': results}, f, ensure_ascii=False, indent=2)
+
+    return 1 if failed else 0
+
+
+def cmd_watch(args):
+    from converter import EpubConverter
+    from watch import BookWatcher
+
+    if not os.path.isdir(args.input):
+        print(f"输入目录不存在: {args.input}")
+        return 2
+
+    converter = EpubConverter(
+        cache_dir=None if args.no_cache else args.cache_dir,
+        include=args.include,
+        exclude=args.exclude,
+        toc_depth=args.toc_depth,
+        toc_max_entries=args.toc_max_entries
+    )
+    watcher = BookWatcher(
+        converter,
+        args.input,
+        args.output,
+        args.title or os.path.basename(os.path.abspath(args.input)),
+        args.author,
+        args.cover,
+        None,
+        args.images_dir,
+        args.interval
+    )
+    watcher.run()
+    return 0
+
+
+def add_discovery_arguments(parser):
+    """章节发现参数：目录中的Markdown文件递归发现，可以用glob筛选"""
+    parser.add_argument('--include', action='append', metavar='GLOB',
+                        help="收录的章节文件，可以多次指定，默认*.md；包含/时匹配相对路径，否则匹配文件名")
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+                        help="排除的文件或子目录，可以多次指定，例如drafts或*.draft.md")
+
+
+def add_toc_arguments(parser):
+    """目录参数：自动生成的目录包含的标题级别和目录项数量上限"""
+    parser.add_argument('--toc-depth', type=int, choices=range(1, 7), default=3, metavar='1-6',
+                        help="目录包含h1到该级别的标题，默认3")
+    parser.add_argument('--toc-max-entries', type=int, default=None, metavar='N',
+                        help="目录项超过N个时从最深的级别开始省略标题")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='md2epub', description="Markdown转EPUB命令行工具")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help="按清单文件批量构建EPUB")
+    build.add_argument('manifest', help="清单文件（.toml或.json）")
+    build.add_argument('--workers', type=int, default=None, help="进程池大小，默认使用CPU核数，1表示不使用进程池")
+    build.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="构建缓存目录")
+    build.add_argument('--cache-size', type=int, default=DEFAULT_SIZE_LIMIT // 1024 // 1024, help="缓存容量上限（MB）")
+    build.add_argument('--no-cache', action='store_true', help="不使用构建缓存")
+    build.add_argument('--clear-cache', action='store_true', help="构建前清空构建缓存")
+    build.add_argument('--streaming', action='store_true', help="流式输出，图片不读入内存")
+    build.add_argument('--max-image-size', type=int, default=None, help="图片最大边长，超过时等比缩小")
+    build.add_argument('--image-format', choices=['jpeg', 'webp'], default=None, help="把照片类的不透明PNG转换为指定格式（截图等颜色较少的PNG不转换）")
+    build.add_argument('--split-level', type=int, choices=[1, 2], default=None,
+                       help="把大章节在顶层h1（1）或h1和h2（2）标题处切分为多个文件")
+    build.add_argument('--split-size', type=int, default=0, help="只切分不小于该大小（KB）的Markdown文件")
+    build.add_argument('--reproducible', action='store_true',
+                       help="可重现构建：相同的输入生成字节相同的EPUB（时间戳取自SOURCE_DATE_EPOCH）")
+    build.add_argument('--compress-level', type=int, choices=range(10), default=6, metavar='0-9',
+                       help="文本条目的deflate压缩级别，0为只存储，默认6")
+    build.add_argument('--compress-media', action='store_true',
+                       help="同时压缩JPEG、PNG、字体等已经压缩的文件（默认直接存储）")
+    build.add_argument('--compression-workers', type=int, default=None,
+                       help="保存EPUB时并行准备条目的线程数")
+    build.add_argument('--highlight', nargs='?', const='default', default=None, metavar='STYLE',
+                       help="用Pygments高亮标明了语言的代码块，可以指定Pygments样式，默认default")
+    build.add_argument('--remote-images', action='store_true',
+                       help="下载http/https图片并嵌入EPUB（启用构建缓存时缓存在磁盘上）")
+    build.add_argument('--remote-workers', type=int, default=8, help="同时下载网络图片的数量")
+    add_discovery_arguments(build)
+    add_toc_arguments(build)
+    build.add_argument('--report', help="把每本书的构建结果和耗时写入JSON文件")
+    build.add_argument('--progress', action='store_true', help="在标准错误中显示每本书的构建进度")
+    build.add_argument('--stats', action='store_true', help="输出每本书的阶段耗时和最慢章节，并写入--report")
+    build.add_argument('--profile', metavar='DIR', help="用cProfile分析每本书的构建，结果写入该目录")
+    build.set_defaults(func=cmd_build)
+
+    watch = subparsers.add_parser('watch', help="监视目录，文件变化时增量重建EPUB")
+    watch.add_argument('input', help="Markdown目录")
+    watch.add_argument('-o', '--output', required=True, help="输出的EPUB文件")
+    watch.add_argument('--title', help="书籍标题，默认使用目录名")
+    watch.add_argument('--author', default='', help="作者")
+    watch.add_argument('--cover', help="封面图片")
+    watch.add_argument('--images-dir', help="图片目录")
+    watch.add_argument('--interval', type=float, default=0.5, help="没有安装watchdog时的轮询间隔（秒）")
+    add_discovery_arguments(watch)
+    add_toc_arguments(watch)
+    watch.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="构建缓存目录")
+    watch.add_argument('--no-cache', action='store_true', help="不使用构建缓存")
+    watch.set_defaults(func=cmd_watch)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+import re
+import html
+import xml.etree.ElementTree as etree
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+from markdown.util import HTML_PLACEHOLDER_RE, STX
+
+# 原始HTML片段中的img标签，src可以使用双引号、单引号或不加引号
+RAW_IMG_SRC = re.compile(r'''<img\b[^>]*?\ssrc\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+))''', re.IGNORECASE)
+
+# 原始HTML片段中的链接和元素ID，用于改写章节之间的链接和收集锚点
+RAW_LINK_HREF = re.compile(r'(<a\b[^>]*?\shref=)(["\'])(.*?)\2', re.IGNORECASE | re.DOTALL)
+RAW_ELEMENT_ID = re.compile(r'<[a-zA-Z][^>]*?\sid=(["\'])(.*?)\1', re.DOTALL)
+
+# fenced_code生成的代码块，语言在code的class中（language-xxx）
+RAW_CODE_BLOCK = re.compile(r'<pre[^>]*><code\b([^>]*)>(.*?)</code></pre>', re.DOTALL)
+CODE_LANGUAGE = re.compile(r'class="(?:[^"]*\s)?language-([^\s"]+)')
+
+# 分段标记，生成的HTML中为<!--md2epub-split:标题ID-->，按标记切分即得到各分段
+SPLIT_COMMENT = 'md2epub-split:'
+SPLIT_MARKER = f'<!--{SPLIT_COMMENT}'
+
+
+def rewrite_raw_img_src(fragment, rewrite):
+    """改写HTML片段中img标签的src，rewrite(src)返回新地址或None（保持不变）"""
+    parts = []
+    last = 0
+    for match in RAW_IMG_SRC.finditer(fragment):
+        group = next(i for i in (1, 2, 3) if match.group(i) is not None)
+        new_src = rewrite(html.unescape(match.group(group)))
+        if new_src is None:
+            continue
+        start, end = match.span(group)
+        parts.append(fragment[last:start])
+        parts.append(html.escape(new_src))
+        last = end
+    if not parts:
+        return fragment
+    parts.append(fragment[last:])
+    return ''.join(parts)
+
+
+class ImageSrcTreeprocessor(Treeprocessor):
+    """在渲染时改写图片地址，不需要在生成的HTML上再做一遍查找替换
+
+    Markdown图片直接修改元素树中的src；原始HTML中的img标签在html_stash中，
+    只改写这些片段。每个图片地址和改写结果记录在extension.images中。
+    """
+    def __init__(self, md, extension):
+        super().__init__(md)
+        self.extension = extension
+
+    def run(self, root):
+        if self.extension.rewrite is None:
+            return
+        images = self.extension.images
+
+        def rewrite(src):
+            new_src = self.extension.rewrite(src)
+            images.append((src, new_src))
+            return new_src
+
+        for element in root.iter('img'):
+            src = element.get('src')
+            if src:
+                new_src = rewrite(src)
+                if new_src is not None:
+                    element.set('src', new_src)
+
+        blocks = self.md.htmlStash.rawHtmlBlocks
+        for index, block in enumerate(blocks):
+            if isinstance(block, str) and '<img' in block.lower():
+                blocks[index] = rewrite_raw_img_src(block, rewrite)
+
+
+class ImageSrcExtension(Extension):
+    """图片地址改写扩展，渲染前设置rewrite(src)回调"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.rewrite = None
+        self.images = []
+
+    def extendMarkdown(self, md):
+        md.registerExtension(self)
+        # 在inline（20）之后运行，此时行内图片和行内HTML都已生成
+        md.treeprocessors.register(ImageSrcTreeprocessor(md, self), 'image_src', 15)
+
+    def reset(self):
+        self.images = []
+
+
+class ChapterTreeprocessor(Treeprocessor):
+    """渲染时一次遍历章节的元素树：切分分段、改写链接并收集锚点和站内链接
+
+    开启分段时在顶层的h1/h2等标题前插入分段标记，只在顶层元素之间切分，切分后的每个分段
+    都是完整的HTML片段；指向其他分段的页内链接改为跨文件链接。指向其他Markdown文件的链接
+    由extension.rewrite_link(href)改为章节文件。每个分段中的元素ID和站内链接
+    （(文件, 锚点)，文件为空表示本分段）记录在extension.anchors和extension.links中，
+    原始HTML片段（html_stash）中的ID和链接同样处理。
+    需要在toc（5）之后运行，此时所有标题都已有ID。
+    """
+    def __init__(self, md, extension):
+        super().__init__(md)
+        self.extension = extension
+
+    def run(self, root):
+        extension = self.extension
+        split = bool(extension.level and extension.segment_name is not None)
+        tags = {f'h{level}' for level in range(1, extension.level + 1)} if split else ()
+        segment = 0
+        anchors = [[]]
+        segments = {}  # 元素ID -> 所在分段
+        elements = []  # (链接元素, 所在分段)
+        raw_blocks = {}  # 原始HTML片段序号 -> 所在分段
+        children = []
+        for child in root:
+            heading_id = child.get('id')
+            if child.tag in tags and heading_id and children:
+                segment += 1
+                anchors.append([])
+                marker = etree.Comment(SPLIT_COMMENT + heading_id)
+                marker.tail = '\n'
+                children.append(marker)
+            children.append(child)
+
+            for element in child.iter():
+                element_id = element.get('id')
+                if element_id:
+                    anchors[segment].append(element_id)
+                    segments.setdefault(element_id, segment)
+                if element.tag == 'a' and element.get('href'):
+                    elements.append((element, segment))
+                for text in (element.text, element.tail):
+                    if text and STX in text:
+                        for index in HTML_PLACEHOLDER_RE.findall(text):
+                            raw_blocks.setdefault(int(index), segment)
+        if segment:
+            root[:] = children
+
+        links = [[] for _ in anchors]
+        for element, source in elements:
+            href = element.get('href')
+            if split and href.startswith('#'):
+                target = segments.get(href[1:])
+                if target is not None and target != source:
+                    href = extension.segment_name(target) + href
+                    element.set('href', href)
+            else:
+                href = self.rewrite_link(href)
+                element.set('href', href)
+            self.record_link(links[source], href)
+
+        blocks = self.md.htmlStash.rawHtmlBlocks
+        for index, source in raw_blocks.items():
+            block = blocks[index] if index < len(blocks) else None
+            if not isinstance(block, str):
+                continue
+            if 'id=' in block:
+                anchors[source].extend(html.unescape(match.group(2)) for match in RAW_ELEMENT_ID.finditer(block))
+            if 'href' in block:
+                blocks[index] = RAW_LINK_HREF.sub(lambda match: self.rewrite_raw_link(match, links[source]), block)
+
+        extension.anchors = anchors
+        extension.links = links
+
+    def rewrite_link(self, href):
+        """改写指向其他Markdown文件的链接，记录原链接和改写结果"""
+        rewrite = self.extension.rewrite_link
+        new_href = rewrite(href) if rewrite is not None else None
+        if new_href is None:
+            return href
+        self.extension.rewrites.append((href, new_href))
+        return new_href
+
+    def rewrite_raw_link(self, match, links):
+        href = self.rewrite_link(html.unescape(match.group(3)))
+        self.record_link(links, href)
+        return f'{match.group(1)}{match.group(2)}{html.escape(href)}{match.group(2)}'
+
+    @staticmethod
+    def record_link(links, href):
+        """记录站内链接：同一文件中的锚点或其他章节文件，外部链接和书外的路径不记录"""
+        path, _, fragment = href.partition('#')
+        if ':' in path or path.startswith(('/', '../')):
+            return
+        if path == '' or path.endswith('.xhtml'):
+            links.append((path, fragment))
+
+
+class ChapterExtension(Extension):
+    """章节扩展：分段、链接改写和锚点收集
+
+    渲染前设置level和segment_name(序号)（不分段时level为None）以及rewrite_link(href)，
+    渲染后anchors、links为每个分段的元素ID和站内链接，rewrites为[(原链接, 改写后的链接)]。
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.level = None
+        self.segment_name = None
+        self.rewrite_link = None
+        self.reset()
+
+    def extendMarkdown(self, md):
+        md.registerExtension(self)
+        md.treeprocessors.register(ChapterTreeprocessor(md, self), 'chapter', 4)
+
+    def reset(self):
+        self.anchors = [[]]
+        self.links = [[]]
+        self.rewrites = []
+
+
+class HighlightTreeprocessor(Treeprocessor):
+    """用extension.highlight(语言, 代码)高亮标明了语言的代码块
+
+    fenced_code把代码块作为原始HTML保存在html_stash中，只需改写这些片段；
+    highlight返回None（例如不认识的语言）时代码块保持不变。
+    """
+    def __init__(self, md, extension):
+        super().__init__(md)
+        self.extension = extension
+
+    def run(self, root):
+        highlight = self.extension.highlight
+        if highlight is None:
+            return
+
+        def replace(match):
+            language = CODE_LANGUAGE.search(match.group(1))
+            if language is None:
+                return match.group(0)
+            highlighted = highlight(language.group(1), html.unescape(match.group(2)))
+            return match.group(0) if highlighted is None else highlighted
+
+        blocks = self.md.htmlStash.rawHtmlBlocks
+        for index, block in enumerate(blocks):
+            if isinstance(block, str) and '<pre' in block:
+                blocks[index] = RAW_CODE_BLOCK.sub(replace, block)
+
+
+class HighlightExtension(Extension):
+    """代码高亮扩展，渲染前设置highlight(语言, 代码)回调，返回高亮后的HTML或None"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.highlight = None
+
+    def extendMarkdown(self, md):
+        md.treeprocessors.register(HighlightTreeprocessor(md, self), 'highlight', 16)
@@ -0,0 +1,210 @@
+import re
+import time
+import threading
+import http.client
+from urllib.parse import urljoin, urlsplit
+from email.utils import parsedate_to_datetime
+
+from build_cache import BuildCache, DEFAULT_SIZE_LIMIT, content_hash
+
+USER_AGENT = 'md2epub'
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+
+class RemoteImageError(OSError):
+    """网络图片下载失败"""
+
+
+class RemoteImageFetcher:
+    """并发下载网络图片
+
+    下载在线程池中进行，同时进行的下载数不超过max_workers；同一主机的连接保持打开并在
+    下载之间复用（HTTP keep-alive）。连接错误、超时和5xx/429响应按指数退避重试retries次。
+
+    指定cache_dir时，下载的图片和响应的ETag、Last-Modified保存在磁盘缓存中（remote/），
+    Cache-Control的max-age内直接使用缓存，过期后发送条件请求，服务器返回304时不重新下载；
+    下载失败但有缓存的图片时使用缓存内容。
+    """
+    def __init__(self, cache_dir=None, cache_size_limit=DEFAULT_SIZE_LIMIT, max_workers=8, timeout=10,
+                 retries=2):
+        self.cache = BuildCache(cache_dir, cache_size_limit) if cache_dir else None
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self._executor = None
+        self._futures = {}
+        self._idle = {}  # (协议, 主机, 端口) -> 空闲连接列表
+        self._lock = threading.Lock()
+        self.downloaded = 0
+        self.revalidated = 0
+        self.fresh = 0
+        self.failed = 0
+
+    def submit(self, url):
+        """开始下载图片，返回结果为(内容, Content-Type)的Future，同一地址只下载一次"""
+        with self._lock:
+            future = self._futures.get(url)
+            if future is None:
+                if self._executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='md2epub-fetch')
+                future = self._executor.submit(self.fetch, url)
+                self._futures[url] = future
+            return future
+
+    def fetch(self, url):
+        """下载图片，返回(内容, Content-Type)，失败时抛出RemoteImageError"""
+        key = content_hash(url)
+        meta = self.cache.get_json('remote', key) if self.cache else None
+        data = self.cache.get('remote', key + '.data') if meta else None
+        if data is None:
+            meta = None
+        elif meta.get('expires', 0) > time.time():
+            self._count('fresh')
+            return data, meta.get('content_type')
+
+        headers = {}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            status, response_headers, body = self._get(url, headers)
+        except RemoteImageError:
+            if data is None:
+                self._count('failed')
+                raise
+            # 离线构建时使用上次下载的内容
+            self._count('fresh')
+            return data, meta.get('content_type')
+
+        if status == 304 and data is not None:
+            self._count('revalidated')
+            body = data
+            content_type = meta.get('content_type')
+        else:
+            self._count('downloaded')
+            content_type = response_headers.get('Content-Type', '').split(';')[0].strip() or None
+        self._store(key, url, response_headers, body, content_type, data is None or status != 304, meta)
+        return body, content_type
+
+    def _store(self, key, url, headers, body, content_type, write_data, meta=None):
+        """按响应头把图片和验证信息写入磁盘缓存
+
+        meta为重新验证前的缓存信息：304响应可以不带ETag和Last-Modified，此时沿用原来的值。
+        """
+        if self.cache is None:
+            return
+        cache_control = headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control:
+            return
+        expires = 0
+        match = re.search(r'max-age=(\d+)', cache_control)
+        if match and 'no-cache' not in cache_control:
+            expires = time.time() + int(match.group(1))
+        elif headers.get('Expires'):
+            try:
+                expires = parsedate_to_datetime(headers['Expires']).timestamp()
+            except (TypeError, ValueError):
+                expires = 0
+        if write_data:
+            # 先写内容再写元数据，元数据存在时内容一定完整
+            self.cache.put('remote', key + '.data', body)
+        # 新下载的内容只使用本次响应的验证信息，304响应则合并到原来的验证信息上
+        meta = {} if write_data else dict(meta or {})
+        meta.update({'url': url, 'content_type': content_type, 'expires': expires})
+        for name, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')):
+            meta[name] = headers.get(header) or meta.get(name)
+        self.cache.put_json('remote', key, meta)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _get(self, url, headers):
+        """发送GET请求并跟随重定向，失败时按指数退避重试，返回(状态码, 响应头, 内容)"""
+        for _ in range(MAX_REDIRECTS + 1):
+            for attempt in range(self.retries + 1):
+                try:
+                    status, response_headers, body = self._request(url, headers)
+                except (OSError, http.client.HTTPException) as e:
+                    error = RemoteImageError(f"{url}: {e}")
+                else:
+                    if status != 429 and status < 500:
+                        break
+                    error = RemoteImageError(f"{url}: HTTP {status}")
+                if attempt < self.retries:
+                    time.sleep(0.5 * 2 ** attempt)
+            else:
+                raise error
+
+            if status in REDIRECT_CODES and response_headers.get('Location'):
+                url = urljoin(url, response_headers['Location'])
+                continue
+            if status not in (200, 304):
+                raise RemoteImageError(f"{url}: HTTP {status}")
+            return status, response_headers, body
+        raise RemoteImageError(f"{url}: 重定向次数过多")
+
+    def _request(self, url, headers):
+        """使用连接池中的连接发送一次请求"""
+        parts = urlsplit(url)
+        host_key = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+
+        conn = self._acquire(host_key)
+        try:
+            conn.request('GET', path, headers=dict(headers, **{'User-Agent': USER_AGENT}))
+            response = conn.getresponse()
+            body = response.read()
+        except BaseException:
+            # 服务器可能已经关闭了空闲连接，丢弃这个连接，重试时会建立新连接
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(host_key, conn)
+        return response.status, response.headers, body
+
+    def _acquire(self, host_key):
+        with self._lock:
+            idle = self._idle.get(host_key)
+            if idle:
+                return idle.pop()
+        scheme, host, port = host_key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _release(self, host_key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(host_key, [])
+            if len(idle) < self.max_workers:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def forget(self):
+        """丢弃已完成的下载结果和计数，开始构建新书时调用，连接和线程池继续复用"""
+        with self._lock:
+            self._futures = {}
+            self.downloaded = self.revalidated = self.fresh = self.failed = 0
+
+    def close(self):
+        """关闭线程池和所有空闲连接"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+            self._futures = {}
+
+    def summary(self):
+        return (f"网络图片: 下载 {self.downloaded} 个，验证未变化 {self.revalidated} 个，"
+                f"直接使用缓存 {self.fresh} 个，失败 {self.failed} 个")
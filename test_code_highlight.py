@@ -0,0 +1,56 @@
+import sys
+
+import pytest
+
+from build_cache import BuildCache
+from code_highlight import CodeHighlighter
+from converter import EpubConverter
+from test_converter import epub_names, epub_text
+
+CHAPTERS = [
+    ('a', '# 一\n\n```python\ndef f(x):\n    return x < 1\n```\n\n```nosuchlang\na < b\n```'),
+    ('b', '# 二\n\n```python\ndef f(x):\n    return x < 1\n```'),
+]
+
+
+def test_highlighted_code_uses_css_classes():
+    pytest.importorskip('pygments')
+    data = EpubConverter(highlight=True).convert_strings(CHAPTERS, '书', '作者')
+
+    text = epub_text(data, 'EPUB/a.xhtml')
+    assert '<div class="codehilite">' in text
+    assert '<span class="k">def</span>' in text
+    assert 'style=' not in text
+    assert 'href="style/code.css"' in text
+    # 不认识的语言保持原样
+    assert '<code class="language-nosuchlang">a &lt; b' in text
+    assert '.codehilite' in epub_text(data, 'EPUB/style/code.css')
+
+
+def test_without_pygments_code_is_unchanged(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'pygments', None)
+    monkeypatch.setitem(sys.modules, 'pygments.formatters', None)
+    data = EpubConverter(highlight=True).convert_strings(CHAPTERS, '书', '作者')
+
+    text = epub_text(data, 'EPUB/a.xhtml')
+    assert 'codehilite' not in text
+    assert '<code class="language-python">def f(x):' in text
+    assert 'EPUB/style/code.css' not in epub_names(data)
+
+
+def test_highlight_results_are_reused(tmp_path, monkeypatch):
+    pytest.importorskip('pygments')
+    converter = EpubConverter(highlight=True)
+    first = converter.convert_strings(CHAPTERS, '书', '作者')
+    # 同一次构建中重复的代码块命中内存中的结果，不认识的语言同样只查找一次
+    assert (converter.highlighter.misses, converter.highlighter.hits) == (2, 1)
+    second = converter.convert_strings(CHAPTERS, '书', '作者')
+    assert (converter.highlighter.misses, converter.highlighter.hits) == (2, 4)
+    assert epub_text(second, 'EPUB/a.xhtml') == epub_text(first, 'EPUB/a.xhtml')
+
+    # 构建缓存中的结果在新的进程（新的高亮器）中直接使用
+    cache = BuildCache(str(tmp_path / 'cache'))
+    expected = CodeHighlighter(cache=cache).highlight('python', 'x = 1\n')
+    highlighter = CodeHighlighter(cache=cache)
+    monkeypatch.setattr(highlighter, '_render', lambda language, code: pytest.fail('没有使用缓存'))
+    assert highlighter.highlight('python', 'x = 1\n') == expected
@@ -0,0 +1,495 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from converter import EpubConverter
+
+# 1x1的PNG图片
+PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010802000000907753de'
+    '0000000c49444154789c63f8cfc0000003010100c9fe92ef0000000049454e44ae426082'
+)
+
+
+def epub_names(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        return zf.namelist()
+
+
+def epub_text(data, name):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        return zf.read(name).decode('utf-8')
+
+
+def test_convert_strings_without_resolver_keeps_image_references(tmp_path):
+    """没有image_resolver时不读取文件系统中的图片，包括之前构建留下的images_dir"""
+    secret = tmp_path / 'secret.png'
+    secret.write_bytes(PNG)
+    converter = EpubConverter()
+    converter.images_dir = str(tmp_path)
+    data = converter.convert_strings([('a', f'![x]({secret})\n\n![y](secret.png)')], '书', '作者')
+
+    assert not [name for name in epub_names(data) if name.startswith('EPUB/images/')]
+    assert str(secret) in epub_text(data, 'EPUB/a.xhtml')
+
+
+def test_convert_strings_with_resolver():
+    converter = EpubConverter()
+    data = converter.convert_strings([('a', '![x](pic.png)')], '书', '作者', image_resolver={'pic.png': PNG}.get)
+    assert [name for name in epub_names(data) if name.startswith('EPUB/images/pic-')]
+
+
+def test_convert_strings_rejects_duplicate_names():
+    converter = EpubConverter()
+    with pytest.raises(ValueError):
+        converter.convert_strings([('a', '# 一'), ('a', '# 二')], '书', '作者')
+
+
+class WriteOnly:
+    """只有write方法的输出流，例如网络响应"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_bytes_written_to_file_objects(streaming):
+    chapters = [('a', '# 一\n\n正文')]
+    stream = WriteOnly()
+    converter = EpubConverter(streaming=streaming)
+    converter.convert_strings(chapters, '书', '作者', output=stream)
+    data = b''.join(stream.chunks)
+    assert epub_names(data)[0] == 'mimetype'
+    assert converter.stats.bytes_written == len(data)
+
+    # 已有内容的文件对象只统计本次写入的部分
+    buffer = io.BytesIO(b'header')
+    buffer.seek(0, io.SEEK_END)
+    converter = EpubConverter(streaming=streaming)
+    converter.convert_strings(chapters, '书', '作者', output=buffer)
+    assert converter.stats.bytes_written == len(buffer.getvalue()) - len(b'header')
+
+
+def write_book(root, chapters):
+    for rel_path, content in chapters.items():
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(content, bytes):
+            path.write_bytes(content)
+        else:
+            path.write_text(content, encoding='utf-8')
+
+
+def build(converter, input_path, output_path, **kwargs):
+    converter.convert_markdown_to_epub(str(input_path), str(output_path), '书', '作者', **kwargs)
+    return output_path.read_bytes()
+
+
+def test_shared_executor_finds_images_added_between_books(tmp_path):
+    """共享进程池的子进程为每本书重建文件索引"""
+    from concurrent.futures import ProcessPoolExecutor
+
+    book = tmp_path / 'book'
+    write_book(book, {'01.md': '# 一\n\n![新图](new.png)', '02.md': '# 二'})
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        converter = EpubConverter(executor=executor)
+        first = build(converter, book, tmp_path / 'first.epub')
+        (book / 'new.png').write_bytes(PNG)
+        second = build(converter, book, tmp_path / 'second.epub')
+
+    assert not [name for name in epub_names(first) if name.startswith('EPUB/images/new-')]
+    assert [name for name in epub_names(second) if name.startswith('EPUB/images/new-')]
+
+
+def test_single_file_build_does_not_index_parent_directory(tmp_path):
+    """单文件构建不扫描文档所在的目录树，图片直接查询文件系统"""
+    write_book(tmp_path, {'one.md': '# 一\n\n![图](pic.png)', 'pic.png': PNG})
+    for i in range(20):
+        write_book(tmp_path, {f'other/{i}.txt': 'x'})
+    converter = EpubConverter()
+    data = build(converter, tmp_path / 'one.md', tmp_path / 'one.epub')
+
+    assert not converter.image_index.files
+    assert [name for name in epub_names(data) if name.startswith('EPUB/images/pic-')]
+
+
+def test_images_in_hidden_and_symlinked_directories(tmp_path):
+    """扫描时跳过的隐藏目录和符号链接目录中的图片仍然能找到"""
+    book = tmp_path / 'book'
+    write_book(book, {'01.md': '# 一\n\n![a](.assets/a.png)\n\n![b](linked/b.png)', '.assets/a.png': PNG})
+    write_book(tmp_path, {'elsewhere/b.png': PNG})
+    (book / 'linked').symlink_to(tmp_path / 'elsewhere', target_is_directory=True)
+    data = build(EpubConverter(), book, tmp_path / 'out.epub')
+
+    names = epub_names(data)
+    assert [name for name in names if name.startswith('EPUB/images/a-')]
+    assert [name for name in names if name.startswith('EPUB/images/b-')]
+
+
+def test_nested_chapter_names_do_not_collide(tmp_path):
+    """guide/intro.md与guide-intro.md生成不同的章节文件"""
+    book = tmp_path / 'book'
+    write_book(book, {'guide-intro.md': '# 平铺', 'guide/intro.md': '# 嵌套', 'guide~/intro.md': '# 波浪'})
+    data = build(EpubConverter(), book, tmp_path / 'out.epub')
+
+    names = [name for name in epub_names(data) if name.endswith('.xhtml') and name != 'EPUB/nav.xhtml']
+    assert len(names) == len(set(names)) == 3
+    assert '平铺' in epub_text(data, 'EPUB/guide-intro.xhtml')
+    assert '嵌套' in epub_text(data, 'EPUB/guide~-intro.xhtml')
+
+
+LINKED_BOOK = {
+    '01-intro.md': ('# 简介\n\n见[安装](guide/install.md#setup)、[原始锚点](guide/install.md#raw)、'
+                    '[第二部分](guide/install.md#part-two)和[不存在](missing.md)。\n\n'
+                    '<p><a href="guide/install.md#setup">原始HTML中的链接</a></p>\n'),
+    'guide/install.md': ('# 安装\n\n## setup\n\n正文\n\n<a id="raw"></a>\n\n'
+                         '# 第二部分 {#part-two}\n\n[回到setup](#setup)\n'),
+}
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_links_are_rewritten_and_indexed_during_rendering(tmp_path, streaming):
+    """流式输出时，链接到后面章节分段中锚点的章节等目标章节加入后再写入"""
+    book = tmp_path / 'book'
+    write_book(book, LINKED_BOOK)
+    converter = EpubConverter(split_level=1, streaming=streaming)
+    data = build(converter, book, tmp_path / 'out.epub')
+
+    intro = epub_text(data, 'EPUB/01-intro.xhtml')
+    assert 'href="guide~-install.xhtml#setup"' in intro
+    assert 'href="guide~-install.xhtml#raw"' in intro
+    # 锚点位于第二个分段时，链接指向该分段
+    assert 'href="guide~-install-part2.xhtml#part-two"' in intro
+    assert '<a href="guide~-install.xhtml#setup">原始HTML中的链接</a>' in intro
+    assert 'href="guide~-install.xhtml#setup"' in epub_text(data, 'EPUB/guide~-install-part2.xhtml')
+    assert converter.dangling_links == [('01-intro.xhtml', 'missing.xhtml')]
+
+
+def test_cached_chapters_keep_anchors_and_links(tmp_path):
+    book = tmp_path / 'book'
+    write_book(book, LINKED_BOOK)
+    cache_dir = str(tmp_path / 'cache')
+    first = build(EpubConverter(cache_dir=cache_dir, reproducible=True), book, tmp_path / 'first.epub')
+    converter = EpubConverter(cache_dir=cache_dir, reproducible=True)
+    second = build(converter, book, tmp_path / 'second.epub')
+
+    assert converter.stats.cache_hits == 2
+    assert first == second
+    assert converter.dangling_links == [('01-intro.xhtml', 'missing.xhtml')]
+
+
+def test_split_size_counts_bytes():
+    """split_size按字节计算：约1400个字符、4.2KB的中文章节达到4000字节的阈值"""
+    md_content = '# 一\n\n' + '中' * 1400 + '\n\n# 二\n\n正文\n'
+    converter = EpubConverter(split_level=1, split_size=4000)
+    converter.convert_strings([('a', md_content)], '书', '作者')
+    assert len(converter.book.get_item_with_href('a.xhtml').segments) == 1
+
+    converter = EpubConverter(split_level=1, split_size=5000)
+    converter.convert_strings([('a', md_content)], '书', '作者')
+    assert not converter.book.get_item_with_href('a.xhtml').segments
+
+
+def test_stats_record_image_lookups_and_cache_hits(tmp_path):
+    """图片索引的查找次数和图片优化缓存的命中次数计入构建统计，包括子进程中的查找"""
+    from image_pipeline import ImagePipeline
+
+    book = tmp_path / 'book'
+    write_book(book, {'01.md': '![a](a.png)\n\n![缺](missing.png)', '02.md': '![a](a.png)', 'a.png': PNG})
+    cache_dir = str(tmp_path / 'cache')
+    for workers in (None, 2):
+        pipeline = ImagePipeline(max_dimension=100, workers=1)
+        first = EpubConverter(cache_dir=cache_dir, image_pipeline=pipeline, workers=workers)
+        build(first, book, tmp_path / 'first.epub')
+        converter = EpubConverter(cache_dir=cache_dir, image_pipeline=pipeline, workers=workers)
+        build(converter, book, tmp_path / 'second.epub')
+
+        stats = converter.stats.to_dict()
+        assert stats['image_cache_hits'] == 1
+        assert stats['image_cache_misses'] == 0
+        assert stats['image_index_hits'] >= 1
+        assert stats['image_index_misses'] >= 1
+
+
+def test_watch_ignores_its_own_output(tmp_path):
+    """输出文件位于监视的目录中时，写入输出不改变扫描结果"""
+    from watch import BookWatcher
+
+    book = tmp_path / 'book'
+    write_book(book, {'01.md': '# 一'})
+    watcher = BookWatcher(EpubConverter(), str(book), str(book / 'book.epub'), '书', '作者')
+    watcher.build()
+    snapshot = watcher.scan()
+    (book / 'book.epub.tmp').write_bytes(b'partial')
+    watcher.write()
+    assert watcher.scan() == snapshot
+
+
+def test_cmd_build_returns_exit_code_when_converter_creation_fails(tmp_path, monkeypatch):
+    import json
+    import md2epub
+
+    def fail(args, executor):
+        raise ImportError("No module named 'PIL'")
+
+    manifest = tmp_path / 'books.json'
+    manifest.write_text(json.dumps({'books': [{'input': 'a', 'output': 'a.epub', 'title': 't', 'author': 'a'}]}))
+    monkeypatch.setattr(md2epub, 'create_converter', fail)
+    assert md2epub.main(['build', str(manifest), '--workers', '1']) == 2
+
+
+SAMPLE_BOOK = {
+    '01-intro.md': '# 简介\n\n![标志](images/logo.png)\n\n[安装](guide/install.md#setup)\n',
+    '02-usage.md': ('# 使用\n\n![标志](images/logo.png)\n\n![副本](copy.png)\n\n## 命令\n\n正文\n\n'
+                    '# 配置\n\n## 命令\n\n正文\n'),
+    'guide/install.md': '# 安装\n\n## setup\n\n正文\n',
+    'images/logo.png': PNG,
+    'copy.png': PNG,
+}
+
+
+def build_sample(tmp_path, name, source='book', **kwargs):
+    book = tmp_path / source
+    if not book.exists():
+        write_book(book, SAMPLE_BOOK)
+    return build(EpubConverter(reproducible=True, **kwargs), book, tmp_path / f'{name}.epub')
+
+
+def test_parallel_output_matches_serial(tmp_path):
+    """进程池并行渲染（自建或共享进程池）与串行构建的结果逐字节相同"""
+    from concurrent.futures import ProcessPoolExecutor
+
+    serial = build_sample(tmp_path, 'serial', split_level=1)
+    assert build_sample(tmp_path, 'parallel', split_level=1, workers=2) == serial
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert build_sample(tmp_path, 'shared', split_level=1, executor=executor) == serial
+
+
+def test_worker_keeps_file_index_per_book(tmp_path):
+    """共享进程池中交替渲染几本书时，每本书复用自己的文件索引和图片登记"""
+    import converter as converter_module
+
+    write_book(tmp_path, {'a.md': '![图](pic.png)', 'pic.png': PNG})
+    options = EpubConverter()._worker_options()
+    md_path, root = str(tmp_path / 'a.md'), str(tmp_path)
+    first = converter_module._render_chapter_job(md_path, options, None, 'book-1', root)
+    index = converter_module._worker_books['book-1'].image_index
+    converter_module._render_chapter_job(md_path, options, None, 'book-2', root)
+    again = converter_module._render_chapter_job(md_path, options, None, 'book-1', root)
+
+    assert converter_module._worker_books['book-1'].image_index is index
+    # 图片已经随第一次的结果返回给主进程
+    assert len(first[3]) == 1 and again[3] == []
+    for token in range(converter_module.WORKER_BOOKS):
+        converter_module._render_chapter_job(md_path, options, None, token, root)
+    assert 'book-1' not in converter_module._worker_books
+
+
+def test_concurrent_convert_async(tmp_path):
+    """同一个事件循环中同时进行的构建使用共享进程池，结果与单独构建相同"""
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor
+
+    expected = build_sample(tmp_path, 'serial', split_level=1)
+    write_book(tmp_path / 'other', LINKED_BOOK)
+
+    async def convert_both(converter):
+        return await asyncio.gather(
+            converter.convert_async(str(tmp_path / 'book'), str(tmp_path / 'a.epub'), '书', '作者'),
+            converter.convert_async(str(tmp_path / 'book'), str(tmp_path / 'b.epub'), '书', '作者'),
+            converter.convert_async(str(tmp_path / 'other'), str(tmp_path / 'c.epub'), '书', '作者'),
+        )
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        converter = EpubConverter(executor=executor, reproducible=True, split_level=1)
+        results = asyncio.run(convert_both(converter))
+    assert [output for output, _ in results] == [str(tmp_path / name) for name in ('a.epub', 'b.epub', 'c.epub')]
+    assert (tmp_path / 'a.epub').read_bytes() == (tmp_path / 'b.epub').read_bytes() == expected
+    assert all(stats.chapters for _, stats in results)
+    # 构建在clone上进行，不修改原来的转换器
+    assert converter.book is None
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_cancel_convert_async(tmp_path, streaming):
+    """取消等待中的构建时抛出CancelledError，不留下输出文件"""
+    import asyncio
+    import threading
+
+    book = tmp_path / 'book'
+    write_book(book, SAMPLE_BOOK)
+    output = tmp_path / 'out.epub'
+    started, release = threading.Event(), threading.Event()
+
+    def progress(stage, current, total, message):
+        if stage == 'chapter':
+            started.set()
+            release.wait(5)
+
+    async def cancel_build():
+        converter = EpubConverter(progress=progress, streaming=streaming)
+        task = asyncio.create_task(converter.convert_async(str(book), str(output), '书', '作者'))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        task.cancel()
+        await asyncio.sleep(0.05)
+        release.set()
+        await task
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(cancel_build())
+    assert not output.exists()
+
+
+def test_stream_async(tmp_path):
+    """stream_async按块返回的内容与构建的文件相同，结束后删除临时文件"""
+    import asyncio
+    import glob
+    import tempfile
+
+    expected = build_sample(tmp_path, 'file')
+
+    async def collect():
+        converter = EpubConverter(reproducible=True)
+        return [chunk async for chunk in converter.stream_async(str(tmp_path / 'book'), '书', '作者',
+                                                                chunk_size=1024)]
+
+    before = set(glob.glob(os.path.join(tempfile.gettempdir(), 'md2epub-*')))
+    chunks = asyncio.run(collect())
+    assert len(chunks) > 1 and all(len(chunk) <= 1024 for chunk in chunks)
+    assert b''.join(chunks) == expected
+    assert set(glob.glob(os.path.join(tempfile.gettempdir(), 'md2epub-*'))) == before
+
+
+def test_reproducible_builds_are_byte_identical(tmp_path, monkeypatch):
+    """可重现构建：重复构建和在其他目录构建得到相同的字节，流式输出的重复构建同样如此"""
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1700000000')
+    first = build_sample(tmp_path, 'first')
+    assert build_sample(tmp_path, 'second') == first
+    assert build_sample(tmp_path, 'moved', source='other') == first
+    streamed = build_sample(tmp_path, 'streamed', streaming=True)
+    assert build_sample(tmp_path, 'streamed-moved', source='other', streaming=True) == streamed
+
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1700000001')
+    assert build_sample(tmp_path, 'later') != first
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+@pytest.mark.parametrize('compress_level, store_media, text, media', [
+    (6, True, zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED),
+    (6, False, zipfile.ZIP_DEFLATED, zipfile.ZIP_DEFLATED),
+    (0, True, zipfile.ZIP_STORED, zipfile.ZIP_STORED),
+    (0, False, zipfile.ZIP_STORED, zipfile.ZIP_STORED),
+])
+def test_compression_settings(tmp_path, streaming, compress_level, store_media, text, media):
+    """mimetype总是第一个且直接存储，文本和媒体条目按压缩设置存储，级别0时全部直接存储"""
+    data = build_sample(tmp_path, 'out', streaming=streaming, compress_level=compress_level,
+                        store_media=store_media)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        infos = zf.infolist()
+    assert infos[0].filename == 'mimetype' and infos[0].compress_type == zipfile.ZIP_STORED
+    types = {info.filename: info.compress_type for info in infos}
+    assert {types[name] for name in types if name.endswith(('.xhtml', '.opf', '.ncx'))} == {text}
+    assert {types[name] for name in types if name.endswith('.png')} == {media}
+
+
+def test_images_are_stored_once(tmp_path):
+    """同一图片被多个章节引用时只存储一份，dedupe_images_by_content时内容相同的文件也只存储一份"""
+    book = tmp_path / 'book'
+    write_book(book, SAMPLE_BOOK)
+    images = [name for name in epub_names(build(EpubConverter(), book, tmp_path / 'a.epub'))
+              if name.startswith('EPUB/images/')]
+    assert len(images) == 2
+
+    converter = EpubConverter(dedupe_images_by_content=True)
+    images = [name for name in epub_names(build(converter, book, tmp_path / 'b.epub'))
+              if name.startswith('EPUB/images/')]
+    assert len(images) == 1
+
+
+def test_split_chapters_and_nested_toc(tmp_path):
+    """大章节在h1处分段，目录按标题层级嵌套并指向标题所在的分段，同名标题的目录项ID不重复"""
+    import re
+
+    book = tmp_path / 'book'
+    write_book(book, SAMPLE_BOOK)
+    converter = EpubConverter(split_level=1)
+    data = build(converter, book, tmp_path / 'out.epub')
+    assert '配置' in epub_text(data, 'EPUB/02-usage-part2.xhtml')
+    assert '配置' not in epub_text(data, 'EPUB/02-usage.xhtml')
+
+    usage = next(entry for entry in converter.book.toc if entry[0].title == '02-usage')
+    (h1, (command,)), (h1_2, (command_2,)) = usage[1]
+    assert (h1.title, h1_2.title) == ('使用', '配置')
+    assert command.href.startswith('02-usage.xhtml#')
+    assert command_2.href.startswith('02-usage-part2.xhtml#')
+    assert command.uid != command_2.uid
+
+    ids = re.findall(r'navPoint id="([^"]+)"', epub_text(data, 'EPUB/toc.ncx'))
+    assert len(ids) == len(set(ids))
+
+
+def toc_titles(entries):
+    return [(entry[0].title, toc_titles(entry[1])) if isinstance(entry, tuple) else entry.title
+            for entry in entries]
+
+
+def test_toc_depth_and_entry_cap():
+    """目录深度可配置，级别跳跃的标题挂在最近的上级下，目录项超过上限时省略深层标题"""
+    md_content = '# A\n\n### 跳级\n\n## B\n\n### C\n\n#### D\n'
+    expected = {
+        (2, None): [('a', [('A', ['B'])])],
+        (6, None): [('a', [('A', ['跳级', ('B', [('C', ['D'])])])])],
+        (6, 3): [('a', [('A', ['B'])])],
+        (6, 2): [('a', ['A'])],
+    }
+    for (depth, cap), toc in expected.items():
+        converter = EpubConverter(toc_depth=depth, toc_max_entries=cap)
+        converter.convert_strings([('a', md_content)], '书', '作者')
+        assert toc_titles(converter.book.toc) == toc
+
+
+def test_cache_invalidation(tmp_path):
+    """章节内容或引用的图片变化时不使用缓存的结果"""
+    book = tmp_path / 'book'
+    write_book(book, {'01.md': '# 一\n\n![图](pic.png)', '02.md': '# 二'})
+    cache_dir = str(tmp_path / 'cache')
+    build(EpubConverter(cache_dir=cache_dir), book, tmp_path / 'a.epub')
+
+    converter = EpubConverter(cache_dir=cache_dir)
+    build(converter, book, tmp_path / 'b.epub')
+    assert (converter.stats.cache_hits, converter.stats.cache_misses) == (2, 0)
+
+    (book / 'pic.png').write_bytes(PNG)
+    (book / '02.md').write_text('# 二（修改）', encoding='utf-8')
+    converter = EpubConverter(cache_dir=cache_dir)
+    data = build(converter, book, tmp_path / 'c.epub')
+    assert (converter.stats.cache_hits, converter.stats.cache_misses) == (0, 2)
+    assert [name for name in epub_names(data) if name.startswith('EPUB/images/pic-')]
+    assert '修改' in epub_text(data, 'EPUB/02.xhtml')
+
+
+def test_toc_ids_are_unique_across_chapters():
+    import re
+
+    converter = EpubConverter()
+    data = converter.convert_strings([('a b', '# 一\n\n## x'), ('a_b', '# 二\n\n## x'), ('a#b', '# 三')], '书', '作者')
+    ids = re.findall(r'navPoint id="([^"]+)"', epub_text(data, 'EPUB/toc.ncx'))
+    assert len(ids) == len(set(ids))
+
+
+def test_reproducible_build_with_cover(tmp_path):
+    """设置封面的可重现构建同样逐字节相同"""
+    book = tmp_path / 'book'
+    write_book(book, {'01.md': '# 一', 'cover.png': PNG})
+    cover = str(book / 'cover.png')
+    first = build(EpubConverter(reproducible=True), book, tmp_path / 'a.epub', cover_path=cover)
+    assert build(EpubConverter(reproducible=True), book, tmp_path / 'b.epub', cover_path=cover) == first
+    assert 'EPUB/cover.jpg' in epub_names(first)
+
+    chapters = [('a', '# 一')]
+    data = EpubConverter(reproducible=True).convert_strings(chapters, '书', '作者', cover=PNG)
+    assert EpubConverter(reproducible=True).convert_strings(chapters, '书', '作者', cover=PNG) == data
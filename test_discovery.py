@@ -0,0 +1,50 @@
+import os
+
+from converter import EpubConverter
+from discovery import iter_markdown_files, matches, natural_key, path_key
+from test_converter import build, epub_names, write_book
+
+
+def relative(root, paths):
+    return [os.path.relpath(path, root).replace(os.sep, '/') for path in paths]
+
+
+def test_natural_sort():
+    names = ['ch10.md', 'ch2.md', 'Ch1.md', 'appendix.md', 'ch2a.md']
+    assert sorted(names, key=natural_key) == ['appendix.md', 'Ch1.md', 'ch2.md', 'ch2a.md', 'ch10.md']
+    assert sorted(['part10/a.md', 'part9/b.md', 'part9.md'], key=path_key) == \
+        ['part9/b.md', 'part9.md', 'part10/a.md']
+
+
+def test_matches_name_and_path_patterns():
+    assert matches('guide/intro.md', ['*.md'])
+    assert matches('guide/intro.md', ['guide/*'])
+    assert not matches('other/intro.md', ['guide/*'])
+    assert not matches('guide/intro.txt', ['*.md'])
+
+
+def test_iter_markdown_files_order_and_globs(tmp_path):
+    write_book(tmp_path, {
+        'ch10.md': '', 'ch2.md': '', 'notes.txt': '', 'README.md': '',
+        'part1/b.md': '', 'part1/a.markdown': '', 'part1/drafts/x.md': '',
+        '.git/HEAD.md': '',
+    })
+    assert relative(tmp_path, iter_markdown_files(str(tmp_path))) == \
+        ['ch2.md', 'ch10.md', 'part1/b.md', 'part1/drafts/x.md', 'README.md']
+
+    found = iter_markdown_files(str(tmp_path), include=['*.md', '*.markdown'], exclude=['README.md', 'drafts'])
+    assert relative(tmp_path, found) == ['ch2.md', 'ch10.md', 'part1/a.markdown', 'part1/b.md']
+
+    # 包含/的模式匹配相对路径，与fnmatch相同，*也匹配/
+    found = iter_markdown_files(str(tmp_path), include=['part1/*.md'])
+    assert relative(tmp_path, found) == ['part1/b.md', 'part1/drafts/x.md']
+
+
+def test_directory_build_uses_discovery_order(tmp_path):
+    book = tmp_path / 'book'
+    write_book(book, {'ch10.md': '# 十', 'ch2.md': '# 二', 'drafts/wip.md': '# 草稿'})
+    converter = EpubConverter(exclude=['drafts'])
+    build(converter, book, tmp_path / 'out.epub')
+
+    assert [item.file_name for item in converter.book.spine if item != 'nav'] == ['ch2.xhtml', 'ch10.xhtml']
+    assert 'EPUB/drafts~-wip.xhtml' not in epub_names((tmp_path / 'out.epub').read_bytes())
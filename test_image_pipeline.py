@@ -0,0 +1,41 @@
+import pytest
+
+from image_pipeline import ImagePipeline, optimize_image
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def save_png(path, im):
+    im.save(path, 'PNG')
+    return str(path)
+
+
+def screenshot(size=(400, 300)):
+    """颜色很少的图片：白底上的色块和文字线条"""
+    from PIL import ImageDraw
+
+    im = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(im)
+    draw.rectangle((0, 0, size[0], 30), fill=(40, 90, 200))
+    for y in range(50, size[1], 20):
+        draw.text((10, y), 'def convert(path): return path', fill='black')
+    return im
+
+
+def photo(size=(400, 300)):
+    """颜色连续变化的噪点图片"""
+    return Image.merge('RGB', [Image.effect_noise(size, sigma) for sigma in (30, 50, 70)])
+
+
+@pytest.mark.parametrize('convert_to, extension', [('jpeg', '.jpg'), ('webp', '.webp')])
+def test_only_photo_pngs_are_converted(tmp_path, convert_to, extension):
+    pipeline = ImagePipeline(convert_to=convert_to)
+    photo_path = save_png(tmp_path / 'photo.png', photo())
+    screenshot_path = save_png(tmp_path / 'screenshot.png', screenshot())
+    transparent_path = save_png(tmp_path / 'transparent.png', photo().convert('RGBA'))
+
+    assert pipeline.target_extension(photo_path) == extension
+    assert optimize_image(photo_path, pipeline.options())[1] == convert_to.upper()
+    for path in (screenshot_path, transparent_path):
+        assert pipeline.target_extension(path) is None
+        assert optimize_image(path, pipeline.options())[1] == 'PNG'
@@ -0,0 +1,92 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from converter import EpubConverter
+from remote_images import RemoteImageError, RemoteImageFetcher
+from test_converter import PNG, build, epub_names, epub_text, write_book
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """/pic.png带ETag返回图片，条件请求匹配时返回不带验证信息的304；/slow.png超时；其他地址404"""
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.path == '/slow.png':
+            time.sleep(1)
+        if self.path != '/pic.png':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('ETag', '"v1"')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(PNG)))
+        self.end_headers()
+        self.wfile.write(PNG)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    ImageHandler.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch_and_revalidate_from_cache(server, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    fetcher = RemoteImageFetcher(cache_dir=cache_dir)
+    assert fetcher.fetch(f'{server}/pic.png') == (PNG, 'image/png')
+    assert fetcher.downloaded == 1
+    fetcher.close()
+
+    # 304响应不带ETag时沿用缓存中的ETag，之后的构建仍然发送条件请求
+    for _ in range(2):
+        fetcher = RemoteImageFetcher(cache_dir=cache_dir)
+        assert fetcher.fetch(f'{server}/pic.png') == (PNG, 'image/png')
+        assert (fetcher.downloaded, fetcher.revalidated) == (0, 1)
+        fetcher.close()
+    assert ImageHandler.requests == [('/pic.png', None), ('/pic.png', '"v1"'), ('/pic.png', '"v1"')]
+
+
+def test_fetch_errors(server):
+    fetcher = RemoteImageFetcher(timeout=0.2, retries=0)
+    with pytest.raises(RemoteImageError):
+        fetcher.fetch(f'{server}/missing.png')
+    with pytest.raises(RemoteImageError):
+        fetcher.fetch(f'{server}/slow.png')
+    assert fetcher.failed == 2
+    fetcher.close()
+
+
+def test_failed_remote_images_keep_original_url(server, tmp_path):
+    book = tmp_path / 'book'
+    write_book(book, {'a.md': f'![有](<{server}/pic.png>)\n\n![无](<{server}/missing.png>)'})
+    converter = EpubConverter(remote_images=True)
+    data = build(converter, book, tmp_path / 'out.epub')
+
+    images = [name for name in epub_names(data) if name.startswith('EPUB/images/')]
+    assert len(images) == 1
+    text = epub_text(data, 'EPUB/a.xhtml')
+    assert f'src="{server}/missing.png"' in text
+    assert f'src="{server}/pic.png"' not in text
+    # 构建结束后关闭下载线程池和连接
+    assert converter.remote_fetcher._executor is None
+    assert not converter.remote_fetcher._idle
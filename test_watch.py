@@ -0,0 +1,61 @@
+import io
+import re
+import zipfile
+
+import pytest
+
+from converter import EpubConverter
+from test_converter import PNG, SAMPLE_BOOK, build, toc_titles, write_book
+from watch import BookWatcher
+
+
+def epub_entries(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        return {name: zf.read(name) for name in zf.namelist()}
+
+
+def manifest(opf):
+    return sorted(re.findall(rb'<item href="([^"]+)"[^>]* media-type="([^"]+)"', opf))
+
+
+def assert_same_book(watcher, tmp_path, split_level):
+    """增量更新的结果与重新完整构建的结果相同：条目内容、目录和书脊顺序"""
+    watcher.write()
+    with open(watcher.output_path, 'rb') as f:
+        incremental = epub_entries(f.read())
+    converter = EpubConverter(reproducible=True, split_level=split_level)
+    full = epub_entries(build(converter, watcher.input_dir, tmp_path / 'full.epub'))
+
+    assert sorted(incremental) == sorted(full)
+    # OPF中条目的顺序和ID与条目加入书籍的顺序有关，只比较manifest中的文件，其余条目逐字节相同
+    for name in full:
+        if name.endswith('.opf'):
+            assert manifest(full[name]) and manifest(incremental[name]) == manifest(full[name])
+        else:
+            assert incremental[name] == full[name], name
+    assert toc_titles(watcher.converter.book.toc) == toc_titles(converter.book.toc)
+    spine = [item.file_name for item in watcher.converter.book.spine if item != 'nav']
+    assert spine == [item.file_name for item in converter.book.spine if item != 'nav']
+
+
+@pytest.mark.parametrize('split_level', [None, 1])
+def test_apply_changes_matches_full_rebuild(tmp_path, split_level):
+    book = tmp_path / 'book'
+    write_book(book, dict(SAMPLE_BOOK, **{'03-faq.md': '# 问题\n\n![图](images/later.png)\n'}))
+    converter = EpubConverter(reproducible=True, split_level=split_level)
+    watcher = BookWatcher(converter, book, tmp_path / 'out.epub', '书', '作者')
+    watcher.build()
+    assert not [item for item in converter.book.get_items() if item.file_name.startswith('images/later')]
+    snapshot = watcher.scan()
+
+    # 修改、新增和删除章节，新增的图片使之前找不到的引用生效
+    write_book(book, {
+        '01-intro.md': '# 简介\n\n修改后的内容\n\n## New section\n',
+        'guide/usage.md': '# 用法\n\n[简介](../01-intro.md#new-section)\n',
+        'images/later.png': PNG,
+    })
+    (book / 'guide' / 'install.md').unlink()
+    new_snapshot = watcher.scan()
+    assert watcher.apply_changes(snapshot, new_snapshot) == 3
+    assert_same_book(watcher, tmp_path, split_level)
+    assert [item for item in converter.book.get_items() if item.file_name.startswith('images/later')]
@@ -0,0 +1,258 @@
+import os
+import time
+import threading
+from discovery import iter_markdown_files, path_key
+
+
+class BookWatcher:
+    """监视Markdown目录，文件变化时增量重建EPUB
+
+    首次完整构建后，只重新渲染修改过的章节、重新处理它们引用的图片，
+    只重建这些章节的目录项，然后重写EPUB文件。
+    安装了watchdog时使用系统文件事件（inotify等），否则定时轮询目录。
+    """
+    def __init__(self, converter, input_dir, output_path, title, author, cover_path=None,
+                 custom_toc=None, images_dir=None, interval=0.5):
+        if converter.streaming:
+            raise ValueError("监视模式需要在内存中保留书籍，不能使用流式输出")
+        self.converter = converter
+        self.input_dir = input_dir
+        self.output_path = os.path.abspath(output_path)
+        self.title = title
+        self.author = author
+        self.cover_path = cover_path
+        self.custom_toc = custom_toc
+        self.images_dir = images_dir
+        self.interval = interval
+
+        self.chapters = {}     # Markdown路径 -> 章节
+        self.toc_entries = {}  # Markdown路径 -> 该章节的目录项
+        self._event = threading.Event()
+        self._observer = None
+        self._stopped = False
+
+    def build(self):
+        """完整构建一次，记录每个章节和它的目录项"""
+        converter = self.converter
+        converter.create_book(self.title, self.author, self.cover_path)
+        converter.images_dir = self.images_dir
+
+        chapters = converter.add_markdown_directory(self.input_dir)
+        self.chapters = {chapter.file_path: chapter for chapter in chapters}
+        # 先生成目录，确定目录包含的标题级别，之后增量更新的目录项沿用这个级别
+        converter.generate_toc(chapters, self.custom_toc)
+        self.toc_entries = {
+            chapter.file_path: converter.build_chapter_toc(chapter) for chapter in chapters
+        }
+        self.write()
+
+    def write(self):
+        """先写入临时文件再替换，阅读器不会读到写了一半的文件"""
+        tmp_path = self.output_path + '.tmp'
+        self.converter.save_epub(tmp_path)
+        os.replace(tmp_path, self.output_path)
+
+    def scan(self):
+        """扫描目录，返回(Markdown文件状态, 其他文件状态)，状态为(修改时间, 大小)
+        
+        输出文件和写入时的临时文件可能位于监视的目录中，不计入状态，否则每次写入都会触发重建。
+        """
+        md_files = {}
+        for md_path in iter_markdown_files(self.input_dir, self.converter.include, self.converter.exclude):
+            try:
+                stat = os.stat(md_path)
+            except OSError:
+                continue
+            md_files[md_path] = (stat.st_mtime_ns, stat.st_size)
+
+        other_files = {}
+        output_files = {self.output_path, self.output_path + '.tmp'}
+        for root in (self.input_dir, self.images_dir):
+            if not root or not os.path.isdir(root):
+                continue
+            stack = [root]
+            while stack:
+                current = stack.pop()
+                try:
+                    with os.scandir(current) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                if not entry.name.startswith('.'):
+                                    stack.append(entry.path)
+                            elif (entry.is_file() and not entry.name.endswith('.md')
+                                  and os.path.abspath(entry.path) not in output_files):
+                                stat = entry.stat()
+                                other_files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    continue
+        return md_files, other_files
+
+    @staticmethod
+    def _diff(old, new):
+        added = set(new) - set(old)
+        removed = set(old) - set(new)
+        modified = {path for path in set(old) & set(new) if old[path] != new[path]}
+        return added, removed, modified
+
+    def _remove_image(self, img_path):
+        """图片被删除时，从登记表和书籍中移除对应条目"""
+        converter = self.converter
+        href = converter.image_registry.pop(os.path.realpath(img_path), None)
+        if not href:
+            return
+        converter._image_hrefs.discard(href)
+        item = converter.book.get_item_with_href(href)
+        if item is not None:
+            converter.book.items.remove(item)
+
+    def _remove_chapter(self, md_path):
+        """从书籍中移除章节和它的分段"""
+        chapter = self.chapters.pop(md_path, None)
+        self.toc_entries.pop(md_path, None)
+        if chapter is None:
+            return
+        self.converter.unindex_chapter(chapter)
+        for item in [chapter] + getattr(chapter, 'segments', []):
+            self.converter.book.items.remove(item)
+
+    def _reload_image(self, img_path):
+        """图片内容变化但文件名不变时，只替换条目内容"""
+        converter = self.converter
+        href = converter.image_registry.get(os.path.realpath(img_path))
+        item = converter.book.get_item_with_href(href) if href else None
+        if item is None:
+            return
+        if converter.image_pipeline:
+            cache_dir = converter.cache.cache_dir if converter.cache else None
+            data, _, _ = next(converter.image_pipeline.run([img_path], cache_dir))
+        else:
+            with open(img_path, 'rb') as f:
+                data = f.read()
+        item.content = data
+
+    def apply_changes(self, old_snapshot, new_snapshot):
+        """根据两次扫描的差异增量更新书籍，返回重新渲染的章节数"""
+        converter = self.converter
+        md_added, md_removed, md_modified = self._diff(old_snapshot[0], new_snapshot[0])
+        img_added, img_removed, img_modified = self._diff(old_snapshot[1], new_snapshot[1])
+
+        # 按内容命名图片时，内容变化会改变文件名，需要像新增/删除一样处理
+        if converter._name_images_by_content():
+            img_added |= img_modified
+            img_removed |= img_modified
+            img_modified = set()
+
+        # 图片新增或删除会改变图片能否找到，重新渲染引用了这些文件名的章节
+        structural = img_added | img_removed
+        for img_path in structural:
+            converter.image_index.refresh(img_path)
+        for img_path in img_removed:
+            self._remove_image(img_path)
+        if structural:
+            names = {os.path.basename(path) for path in structural}
+            for md_path in new_snapshot[0]:
+                if md_path in md_added or md_path in md_modified:
+                    continue
+                with open(md_path, 'r', encoding='utf-8') as f:
+                    md_content = f.read()
+                if any(name in md_content for name in names):
+                    md_modified.add(md_path)
+
+        for img_path in img_modified:
+            self._reload_image(img_path)
+
+        for md_path in md_removed:
+            self._remove_chapter(md_path)
+
+        for md_path in md_modified:
+            chapter = self.chapters.get(md_path)
+            if chapter is None or converter.split_level:
+                # 开启分段时，重新渲染后分段数可能变化，删除章节后重新添加
+                self._remove_chapter(md_path)
+                md_added.add(md_path)
+                continue
+            html_content, headings, refs = converter.render_markdown_file(md_path)
+            chapter.content = html_content
+            chapter.headings = headings
+            converter.index_chapter(chapter, refs)
+            self.toc_entries[md_path] = converter.build_chapter_toc(chapter)
+
+        for md_path in md_added:
+            chapter = converter.add_markdown_file(md_path)
+            self.chapters[md_path] = chapter
+            self.toc_entries[md_path] = converter.build_chapter_toc(chapter)
+
+        # 只替换变化章节的目录项，其余章节沿用之前的结果，顺序与完整构建时相同
+        paths = sorted(self.chapters, key=lambda path: path_key(os.path.relpath(path, self.input_dir)))
+        chapters = [self.chapters[path] for path in paths]
+        if not self.custom_toc:
+            converter.book.toc = converter.nest_toc(chapters, [self.toc_entries[path] for path in paths])
+        converter.book.spine = ['nav'] + converter.spine_items(chapters)
+
+        # 开启分段时修改的章节同时在md_added中，只计一次
+        return len(md_modified | md_added)
+
+    def _start_observer(self):
+        """有watchdog时使用系统文件事件唤醒，否则返回False改为轮询"""
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return False
+
+        event = self._event
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, _):
+                event.set()
+
+        self._observer = Observer()
+        for root in (self.input_dir, self.images_dir):
+            if root and os.path.isdir(root):
+                self._observer.schedule(Handler(), root, recursive=True)
+        self._observer.start()
+        return True
+
+    def _wait(self):
+        if self._observer is None:
+            time.sleep(self.interval)
+            return
+        self._event.wait()
+        # 合并短时间内的连续事件，例如编辑器保存时的多次写入
+        time.sleep(0.05)
+        self._event.clear()
+
+    def stop(self):
+        self._stopped = True
+        self._event.set()
+
+    def run(self):
+        """完整构建一次，然后持续监视并增量重建，直到调用stop或按下Ctrl+C"""
+        start = time.perf_counter()
+        self.build()
+        print(f"已生成 {self.output_path}（{time.perf_counter() - start:.2f}s）")
+
+        snapshot = self.scan()
+        mode = "文件事件" if self._start_observer() else f"每{self.interval}秒轮询"
+        print(f"正在监视 {self.input_dir}（{mode}），按Ctrl+C停止")
+        try:
+            while not self._stopped:
+                self._wait()
+                new_snapshot = self.scan()
+                if new_snapshot == snapshot:
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    count = self.apply_changes(snapshot, new_snapshot)
+                    self.write()
+                    print(f"已更新 {count} 个章节（{time.perf_counter() - start:.2f}s）")
+                except Exception as e:
+                    print(f"增量重建出错: {str(e)}")
+                snapshot = new_snapshot
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self._observer is not None:
+                self._observer.stop()
+                self._observer.join()